@@ -0,0 +1,36 @@
+import re
+import time
+
+from qbay.validation import valid_email_syntax
+
+'''
+Compares the linear R1-3 email validator with the regular expression it
+replaced on inputs that make the expression backtrack.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_email
+'''
+
+original = re.compile(
+    r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(.[A-Z|a-z]{2,})+')
+
+
+def timed(function, value):
+    start = time.perf_counter()
+    function(value)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    print('%8s %14s %14s' % ('length', 'regex (ms)', 'linear (ms)'))
+    for length in (16, 20, 22, 24, 26, 28):
+        email = '0' * length
+        print('%8i %14.3f %14.3f' % (
+            length,
+            timed(lambda e: re.fullmatch(original, e), email) * 1000,
+            timed(valid_email_syntax, email) * 1000))
+    for length in (1000, 100000):
+        email = '0' * length
+        print('%8i %14s %14.3f' % (
+            length, 'not attempted',
+            timed(valid_email_syntax, email) * 1000))
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Measures login throughput at several password work factors.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_login [logins] [threads]
+'''
+
+# use a throwaway database, this has to happen before importing qbay
+db_dir = tempfile.mkdtemp()
+os.environ['db_string'] = 'sqlite:///' + os.path.join(db_dir, 'bench.sqlite')
+
+from qbay import app  # noqa: E402
+from qbay.models import db, init_schema, register, login  # noqa: E402
+
+COSTS = [1000, 50000, 100000, 260000, 600000]
+PASSWORD = 'Abc#123'
+
+
+def run(cost, logins, threads):
+    '''
+    Registers a user at the given cost and times concurrent logins
+    '''
+    app.config['PASSWORD_ITERATIONS'] = cost
+    email = 'bench%i@test.com' % cost
+    register('bench user', email, PASSWORD)
+
+    def one_login(_):
+        with app.app_context():
+            assert login(email, PASSWORD) is not None
+            db.session.remove()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one_login, range(logins)))
+    elapsed = time.perf_counter() - start
+    print('%8i iterations: %7.1f logins/s  %7.2f ms/login' %
+          (cost, logins / elapsed, elapsed / logins * 1000))
+
+
+if __name__ == '__main__':
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    print('%i logins, %i request threads, %i hashing workers' %
+          (logins, threads, app.config['PASSWORD_WORKERS']))
+    with app.app_context():
+        init_schema()
+        for cost in COSTS:
+            run(cost, logins, threads)
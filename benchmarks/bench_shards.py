@@ -0,0 +1,101 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+'''
+Compares concurrent bookings and the home page's booking lookup with
+all bookings in the main database and with booking_shards=4, each in a
+fresh interpreter with sqlite_profile=tuned.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_shards [bookings per thread] [threads]
+'''
+
+# Runs in the child interpreter, every thread books listings of its own
+# with a guest of its own
+CHILD = '''
+import json, sys, threading, time
+from datetime import date, timedelta
+from qbay import app
+from qbay import models
+
+per_thread, threads = int(sys.argv[1]), int(sys.argv[2])
+app.config['PASSWORD_ITERATIONS'] = 1000
+with app.app_context():
+    models.init_schema()
+    host = models.register('bench host', 'host@bench.com', 'Abc#123')
+    guests = [models.register('bench guest', 'guest%i@bench.com' % number,
+                              'Abc#123') for number in range(threads)]
+    listings = [models.create_listing(
+        'bench listing %i' % number, 'a' * 30, 10, date(2022, 1, 1),
+        host.id).id for number in range(threads * 4)]
+    # enough money for every booking
+    for guest in guests:
+        models.transfer(guest.id, 10 * per_thread, 'deposit')
+    models.db.session.commit()
+    guests = [guest.id for guest in guests]
+
+done = []
+
+
+def book(number):
+    booked = 0
+    with app.app_context():
+        for stay in range(per_thread):
+            start = date(2023, 1, 1) + timedelta(days=3 * stay)
+            listing = listings[number * 4 + stay % 4]
+            if models.create_booking(guests[number], listing, start,
+                                     start + timedelta(days=1)):
+                booked += 1
+    done.append(booked)
+
+
+workers = [threading.Thread(target=book, args=(number,))
+           for number in range(threads)]
+start = time.perf_counter()
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+elapsed = time.perf_counter() - start
+
+with app.app_context():
+    lookup = time.perf_counter()
+    for _ in range(100):
+        models.user_bookings(guests[0])
+    lookup = (time.perf_counter() - lookup) / 100
+print(json.dumps({'bookings': sum(done), 'seconds': elapsed,
+                  'lookup': lookup}))
+'''
+
+
+def run(shard_count, per_thread, threads):
+    '''
+    Books in a fresh interpreter against new databases
+    '''
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ,
+               db_string='sqlite:///' + os.path.join(directory, 'db.sqlite'),
+               session_db=os.path.join(directory, 'sessions.sqlite'),
+               booking_shards=str(shard_count),
+               booking_shard_string='sqlite:///' + os.path.join(
+                   directory, 'bookings_{}.sqlite'),
+               sqlite_profile='tuned', slow_query_log='')
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, str(per_thread), str(threads)],
+        env=env, check=True, capture_output=True, text=True)
+    result = json.loads(output.stdout)
+    print('%-9s %6i booked %9.0f bookings/s  user_bookings %6.2f ms' %
+          ('%i shards' % shard_count if shard_count > 1 else 'unsharded',
+           result['bookings'], result['bookings'] / result['seconds'],
+           result['lookup'] * 1000))
+
+
+if __name__ == '__main__':
+    per_thread = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    print('%i threads booking %i stays each' % (threads, per_thread))
+    for shard_count in (0, 4):
+        run(shard_count, per_thread, threads)
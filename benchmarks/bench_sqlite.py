@@ -0,0 +1,117 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, \
+    create_engine, exc, select
+
+from qbay import app
+from qbay.pool import InstrumentedQueuePool, sqlite_pragmas, tune_sqlite
+
+'''
+Compares SQLite's default settings with the tuned profile
+(sqlite_profile=tuned) under concurrent readers and writers.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_sqlite [seconds] [readers] [writers]
+'''
+
+ROWS = 10000
+
+metadata = MetaData()
+listing = Table(
+    'listing', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('title', String(80), nullable=False),
+    Column('price', Float, nullable=False))
+
+
+def make_engine(tuned, threads):
+    '''
+    Creates a seeded database in a new file
+    '''
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    engine = create_engine('sqlite:///' + path,
+                           poolclass=InstrumentedQueuePool,
+                           pool_size=threads, max_overflow=0)
+    if tuned:
+        tune_sqlite(engine, sqlite_pragmas(app.config))
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(listing.insert(), [
+            {'title': 'listing %i' % i, 'price': 10 + i % 100}
+            for i in range(ROWS)])
+    return engine
+
+
+def run(tuned, seconds, readers, writers):
+    '''
+    Runs readers and writers against one database for some seconds
+    '''
+    engine = make_engine(tuned, readers + writers)
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies = []
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+
+    def reader():
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    low = random.randrange(ROWS)
+                    connection.execute(select(listing).where(
+                        listing.c.id.between(low, low + 20))).all()
+            except exc.OperationalError:
+                with lock:
+                    counts['errors'] += 1
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            counts['reads'] += len(local)
+
+    def writer():
+        done = 0
+        while not stop.is_set():
+            try:
+                with engine.begin() as connection:
+                    connection.execute(listing.insert().values(
+                        title='new listing', price=50))
+                done += 1
+            except exc.OperationalError:
+                with lock:
+                    counts['errors'] += 1
+        with lock:
+            counts['writes'] += done
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)] + \
+        [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print('%-8s %9.0f reads/s %8.0f writes/s  read p99 %7.2f ms  '
+          '%i errors' % ('tuned' if tuned else 'default',
+                         counts['reads'] / seconds,
+                         counts['writes'] / seconds, p99 * 1000,
+                         counts['errors']))
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    print('%i readers, %i writers, %g s each' % (readers, writers, seconds))
+    for tuned in (False, True):
+        run(tuned, seconds, readers, writers)
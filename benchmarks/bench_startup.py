@@ -0,0 +1,65 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+'''
+Measures the cold start of a worker: importing qbay, getting the app
+and answering a first request, each in a fresh interpreter against an
+existing SQLite database.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_startup [runs]
+'''
+
+# Runs in the child interpreter, timing each phase from inside so the
+# interpreter start itself is not counted
+CHILD = '''
+import json, time
+start = time.perf_counter()
+import qbay.models
+imported = time.perf_counter()
+import qbay
+app = qbay.load_app()
+ready = time.perf_counter()
+app.test_client().get('/login')
+answered = time.perf_counter()
+print(json.dumps({'import qbay.models': imported - start,
+                  'load_app': ready - imported,
+                  'first request': answered - ready,
+                  'total': answered - start}))
+'''
+
+
+def prepare(env):
+    '''
+    Creates the schema once, as a deploy would
+    '''
+    subprocess.run([sys.executable, '-m', 'qbay.cli', 'init-db'],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def main(runs):
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ,
+               db_string='sqlite:///' + os.path.join(directory, 'db.sqlite'),
+               session_db=os.path.join(directory, 'sessions.sqlite'))
+    prepare(env)
+
+    phases = {}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', CHILD], env=env,
+                                check=True, capture_output=True, text=True)
+        for phase, seconds in json.loads(output.stdout).items():
+            phases.setdefault(phase, []).append(seconds * 1000)
+
+    print('%i cold starts, median (min) in ms' % runs)
+    for phase, times in phases.items():
+        print('%-20s %7.1f (%.1f)' % (phase, statistics.median(times),
+                                      min(times)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
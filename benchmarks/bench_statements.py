@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import timeit
+from datetime import date
+from sqlalchemy import and_, or_
+
+'''
+Compares the hot lookups built from scratch on every call with the
+statements cached in qbay.models.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_statements [calls]
+'''
+
+# use a throwaway database, this has to happen before importing qbay
+db_dir = tempfile.mkdtemp()
+os.environ['db_string'] = 'sqlite:///' + os.path.join(db_dir, 'bench.sqlite')
+
+from qbay import app  # noqa: E402
+from qbay import models  # noqa: E402
+from qbay.models import Booking, Listing, User, db  # noqa: E402
+
+EMAIL = 'bench@test.com'
+TITLE = 'bench listing'
+START, END = date(2023, 3, 1), date(2023, 3, 3)
+
+
+def rebuilt(listing_id):
+    '''
+    The lookups as they were written before, (name, function) pairs
+    '''
+    return [
+        ('user by email',
+         lambda: User.query.filter_by(email=EMAIL).first()),
+        ('user by id',
+         lambda: db.session.get(User, 1, populate_existing=True)),
+        ('listing by id',
+         lambda: db.session.get(Listing, listing_id,
+                                populate_existing=True)),
+        ('bookings by listing',
+         lambda: Booking.query.filter(
+             Booking.listing_id == listing_id,
+             Booking.start_date <= END,
+             or_(and_(Booking.start_date <= START,
+                      Booking.end_date >= START),
+                 and_(Booking.start_date <= END,
+                      Booking.end_date >= END))).first()),
+        ('title exists',
+         lambda: db.session.query(
+             Listing.query.filter_by(title=TITLE).exists()).scalar()),
+    ]
+
+
+def cached(listing_id):
+    '''
+    The same lookups through the cached statements
+    '''
+    return [
+        ('user by email',
+         lambda: db.session.scalars(models.USER_BY_EMAIL,
+                                    {'value': EMAIL}).first()),
+        ('user by id',
+         lambda: db.session.scalars(models.USER_BY_ID,
+                                    {'value': 1}).first()),
+        ('listing by id',
+         lambda: db.session.scalars(models.LISTING_BY_ID,
+                                    {'value': listing_id}).first()),
+        ('bookings by listing',
+         lambda: db.session.scalar(models.BOOKING_OVERLAP, {
+             'listing_id': listing_id, 'start_date': START,
+             'end_date': END})),
+        ('title exists',
+         lambda: db.session.scalar(models.TITLE_EXISTS, {'title': TITLE})),
+    ]
+
+
+def best(function, calls, repeat=7):
+    '''
+    Returns the fastest time per call in microseconds
+    '''
+    function()
+    return min(timeit.repeat(function, number=calls,
+                             repeat=repeat)) / calls * 1e6
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with app.app_context():
+        models.init_schema()
+        app.config['PASSWORD_ITERATIONS'] = 1000
+        user = models.register('bench user', EMAIL, 'Abc#123')
+        listing = Listing(title=TITLE, description='a' * 30, price=50,
+                          last_modified_date=date(2022, 1, 1),
+                          owner_id=user.id)
+        db.session.add(listing)
+        db.session.commit()
+
+        print('%-20s %10s %10s %8s' % ('lookup', 'rebuilt', 'cached',
+                                       'saved'))
+        for (name, old), (_, new) in zip(rebuilt(listing.id),
+                                         cached(listing.id)):
+            before, after = best(old, calls), best(new, calls)
+            print('%-20s %8.1fus %8.1fus %7.0f%%' %
+                  (name, before, after, 100 * (1 - after / before)))
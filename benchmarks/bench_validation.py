@@ -0,0 +1,81 @@
+import re
+import string
+import timeit
+
+from qbay import validation
+
+'''
+Measures the per-call cost of the shared validators against the
+validation code they replaced, which recompiled its patterns and walked
+the password once per character class.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_validation
+'''
+
+CALLS = 20000
+NAME = 'some user name'
+PASSWORD = 'abcdefghijklmnop#Q'
+POSTAL_CODE = 'K7L 3N6'
+TITLE = 'A lovely house near the lake'
+
+
+def old_name(name):
+    name_validation = re.compile('^(?! )[A-Za-z0-9 ]*(?<! )$')
+    return name != '' and re.fullmatch(name_validation, name) is not None \
+        and 2 < len(name) < 20
+
+
+def old_password(password):
+    def upper(s):
+        for x in s:
+            if x == x.upper():
+                return True
+        return False
+
+    def lower(s):
+        for x in s:
+            if x == x.lower():
+                return True
+        return False
+
+    def special(s):
+        return any(p in s for p in string.punctuation)
+    return len(password) >= 6 and lower(password) and upper(password) \
+        and special(password)
+
+
+def old_postal_code(postal_code):
+    canadian_postal_code = re.compile('[A-Z][0-9][A-Z] [0-9][A-Z][0-9]')
+    return re.fullmatch(canadian_postal_code, postal_code) is not None
+
+
+def old_title(title):
+    return re.match("^(?! )[A-Za-z0-9 ]*(?<! )$", title) is not None \
+        and 0 < len(title) <= 80
+
+
+def per_call(function, value):
+    return timeit.timeit(lambda: function(value), number=CALLS) / CALLS
+
+
+if __name__ == '__main__':
+    cases = [
+        ('name', old_name, validation.valid_name, NAME),
+        ('password', old_password, validation.valid_password, PASSWORD),
+        ('postal code', old_postal_code, validation.valid_postal_code,
+         POSTAL_CODE),
+        ('title', old_title, validation.valid_title, TITLE),
+    ]
+    print('%-12s %12s %12s' % ('validator', 'old (us)', 'new (us)'))
+    for label, old, new, value in cases:
+        assert old(value) == new(value)
+        print('%-12s %12.2f %12.2f' % (label, per_call(old, value) * 1e6,
+                                       per_call(new, value) * 1e6))
+
+    records = [{'name': NAME, 'email': 'user%i@test.com' % i,
+                'password': PASSWORD, 'postal_code': POSTAL_CODE}
+               for i in range(CALLS)]
+    seconds = timeit.timeit(lambda: validation.validate_many(records),
+                            number=1)
+    print('validate_many: %.2f us per record' % (seconds / CALLS * 1e6))
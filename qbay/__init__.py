@@ -2,6 +2,8 @@
 an init file is required for this folder to be considered as a module
 '''
 from flask import Flask
+from qbay.pool import engine_options
+from qbay.shards import shard_binds
 import os
 
 
@@ -20,5 +22,95 @@ if db_string:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../db.sqlite'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# database connection pool: connections kept open, extra connections
+# allowed at peak, seconds to wait for a free connection, seconds before
+# a connection is replaced (below MySQL's wait_timeout) and whether a
+# connection is tested before use
+app.config['DB_POOL_SIZE'] = int(os.getenv('db_pool_size', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('db_max_overflow', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv('db_pool_timeout', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('db_pool_recycle', 1800))
+app.config['DB_POOL_PRE_PING'] = os.getenv('db_pool_pre_ping', '1') == '1'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+# 'tuned' runs SQLite databases in WAL mode with a page cache of
+# sqlite_cache_kb per connection, sqlite_mmap_size bytes of memory
+# mapped I/O and a busy timeout in ms, for single-box deployments.
+# 'default' keeps SQLite's own settings.
+app.config['SQLITE_PROFILE'] = os.getenv('sqlite_profile', 'default')
+app.config['SQLITE_CACHE_KB'] = int(os.getenv('sqlite_cache_kb', 16384))
+app.config['SQLITE_MMAP_SIZE'] = int(
+    os.getenv('sqlite_mmap_size', 268435456))
+app.config['SQLITE_BUSY_TIMEOUT'] = int(
+    os.getenv('sqlite_busy_timeout', 5000))
+# optional read replica: GET requests read from it, and a client reads
+# from the primary for REPLICA_STICKY_SECONDS after a POST so it sees
+# its own writes
+db_replica_string = os.getenv('db_replica_string')
+if db_replica_string:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': db_replica_string}
+app.config['REPLICA_STICKY_SECONDS'] = int(
+    os.getenv('replica_sticky_seconds', 5))
+# optional booking shards: with booking_shards above 1 the bookings are
+# kept in that many SQLite databases named by booking_shard_string, {}
+# standing for the shard number, and each listing books in one of them
+app.config['BOOKING_SHARDS'] = int(os.getenv('booking_shards', 0))
+app.config['BOOKING_SHARD_STRING'] = os.getenv(
+    'booking_shard_string', 'sqlite:///../bookings_{}.sqlite')
+if app.config['BOOKING_SHARDS'] > 1:
+    app.config.setdefault('SQLALCHEMY_BINDS', {}).update(
+        shard_binds(app.config))
 app.config['SECRET_KEY'] = '69cae04b04756f65eabcd2c5a11c8c24'
-app.app_context().push()
+# PBKDF2 work factor and size of the password hashing thread pool
+app.config['PASSWORD_ITERATIONS'] = int(
+    os.getenv('password_iterations', 260000))
+app.config['PASSWORD_WORKERS'] = int(os.getenv('password_workers', 4))
+# login attempts allowed per client IP and per email in LOGIN_WINDOW
+# seconds, and number of IPs/emails tracked
+app.config['LOGIN_RATE_LIMIT'] = os.getenv('login_rate_limit', '1') == '1'
+app.config['LOGIN_ATTEMPTS_PER_IP'] = int(
+    os.getenv('login_attempts_per_ip', 20))
+app.config['LOGIN_ATTEMPTS_PER_EMAIL'] = int(
+    os.getenv('login_attempts_per_email', 5))
+app.config['LOGIN_WINDOW'] = float(os.getenv('login_window', 60))
+app.config['LOGIN_LIMITER_SIZE'] = int(
+    os.getenv('login_limiter_size', 10000))
+# 'sqlite' keeps sessions server-side in session_db, 'cookie' keeps
+# Flask's signed cookie sessions
+app.config['SESSION_BACKEND'] = os.getenv('session_backend', 'sqlite')
+app.config['SESSION_DB'] = os.getenv(
+    'session_db', os.path.join(package_dir, '..', 'sessions.sqlite'))
+if app.config['SESSION_BACKEND'] == 'sqlite':
+    from qbay.sessions import ServerSideSessionInterface, \
+        SQLiteSessionStore
+    app.session_interface = ServerSideSessionInterface(
+        SQLiteSessionStore(app.config['SESSION_DB']))
+# SQL statements a request may run before a warning is logged, and how
+# often one statement may repeat in a request before it is reported as
+# a possible N+1 query
+app.config['QUERY_BUDGET'] = int(os.getenv('query_budget', 20))
+app.config['QUERY_REPEAT_LIMIT'] = int(os.getenv('query_repeat_limit', 5))
+# statements slower than slow_query_ms are written with their query
+# plan to slow_query_log, rotated after slow_query_log_bytes; an empty
+# slow_query_log turns the log off
+app.config['SLOW_QUERY_MS'] = float(os.getenv('slow_query_ms', 100))
+app.config['SLOW_QUERY_LOG'] = os.getenv(
+    'slow_query_log', os.path.join(package_dir, '..', 'slow_queries.log'))
+app.config['SLOW_QUERY_LOG_BYTES'] = int(
+    os.getenv('slow_query_log_bytes', 1048576))
+app.config['SLOW_QUERY_LOG_BACKUPS'] = int(
+    os.getenv('slow_query_log_backups', 5))
+# 'lazy' creates missing tables before the first request of a process,
+# 'deploy' leaves it to 'python -m qbay.cli init-db'
+app.config['SCHEMA_INIT'] = os.getenv('schema_init', 'lazy')
+
+
+def load_app():
+    '''
+    Returns the app with its routes registered. This is not a factory:
+    qbay has one module-level app, configured from the environment when
+    qbay is imported, and every call returns that same app. Importing
+    qbay only configures it, nothing connects to a database before the
+    first request.
+    '''
+    from qbay import controllers  # noqa: F401 registers the routes
+    return app
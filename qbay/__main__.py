@@ -1,7 +1,4 @@
-
-from qbay import app
-from qbay.models import *
-from qbay.controllers import *
+from qbay import load_app
 
 """
 This file runs the server at a given port
@@ -10,4 +7,4 @@ This file runs the server at a given port
 FLASK_PORT = 8081
 
 if __name__ == "__main__":
-    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
+    load_app().run(debug=True, port=FLASK_PORT, host='0.0.0.0')
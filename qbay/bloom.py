@@ -0,0 +1,86 @@
+import hashlib
+import math
+
+
+'''
+This file defines a small in-memory Bloom filter used to skip database
+round trips for values that are known not to exist yet
+'''
+
+
+class BloomFilter:
+    '''
+    Probabilistic set membership
+      Attributes:
+        capacity (int):            expected number of items
+        error_rate (float):        target false positive rate
+        size (int):                number of bits in the filter
+        hash_count (int):          number of hash functions used
+        count (int):               number of items added so far
+
+    A negative answer is always correct, a positive answer may be a
+    false positive and has to be confirmed against the database.
+    '''
+
+    def __init__(self, capacity: int = 10000, error_rate: float = 0.01):
+        if capacity < 1:
+            capacity = 1
+        if not 0 < error_rate < 1:
+            error_rate = 0.01
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(
+            self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        '''
+        Yields the bit positions of item (double hashing)
+        '''
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16)
+        raw = digest.digest()
+        h1 = int.from_bytes(raw[:8], 'little')
+        h2 = int.from_bytes(raw[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        '''
+        Adds item to the filter
+        '''
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, items):
+        '''
+        Adds every item of an iterable to the filter
+        '''
+        for item in items:
+            self.add(item)
+
+    def clear(self):
+        '''
+        Removes every item from the filter
+        '''
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+    def __contains__(self, item: str):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory_bytes(self):
+        '''
+        Size of the bit array in bytes
+        '''
+        return len(self.bits)
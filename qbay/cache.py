@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+This file defines the in-process caches shared by the models and
+controllers
+'''
+
+
+class LRUCache:
+    '''
+    Bounded least recently used cache with an optional time to live
+      Attributes:
+        maxsize (int):             maximum number of entries kept
+        ttl (float):               seconds an entry stays valid, None
+                                   keeps entries until evicted
+        hits (int):                number of successful lookups
+        misses (int):              number of failed lookups
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Returns the value stored under key, or default if it is missing
+        or expired
+        '''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        '''
+        Stores value under key, evicting the least recently used entry
+        when the cache is full
+        '''
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''
+        Removes key from the cache and returns its value
+        '''
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        '''
+        Removes every entry
+        '''
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,205 @@
+import argparse
+import csv
+import sys
+
+
+'''
+This file defines the command line tools of qbay
+
+Usage:
+    python -m qbay.cli import-users users.csv [--chunk-size 500]
+                                              [--rejects rejects.csv]
+    python -m qbay.cli revoke-sessions <user id>
+    python -m qbay.cli snapshot-balances
+    python -m qbay.cli load-fsa-adjacency adjacency.csv
+    python -m qbay.cli migrate status|upgrade|downgrade [version]
+    python -m qbay.cli init-db
+    python -m qbay.cli repair-listing-counters
+    python -m qbay.cli shard-bookings
+'''
+
+
+def import_users(args):
+    '''
+    Registers every user of a CSV file with name, email and password
+    columns, and reports the rows that were rejected
+    '''
+    from qbay.models import register_many
+
+    with open(args.file, newline='') as f:
+        created, rejected = register_many(csv.DictReader(f),
+                                          chunk_size=args.chunk_size)
+
+    print('%i users imported, %i rows rejected' % (created, len(rejected)))
+    if args.rejects:
+        with open(args.rejects, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['row', 'reason'])
+            writer.writerows(rejected)
+    else:
+        for number, reason in rejected:
+            print('row %i: %s' % (number, reason))
+    return 0
+
+
+def revoke_sessions(args):
+    '''
+    Ends every server-side session of a user
+    '''
+    from qbay import app
+    from qbay.sessions import ServerSideSessionInterface
+
+    if not isinstance(app.session_interface, ServerSideSessionInterface):
+        print('sessions are not stored server-side')
+        return 1
+    count = app.session_interface.revoke_user(args.user_id)
+    print('%i sessions revoked' % count)
+    return 0
+
+
+def snapshot_balances(args):
+    '''
+    Records the current balance of every user, meant to run periodically
+    (e.g. from cron) so balance audits stay short
+    '''
+    from qbay.models import snapshot_balances
+
+    print('%i balances recorded' % snapshot_balances())
+    return 0
+
+
+def load_fsa_adjacency(args):
+    '''
+    Replaces the FSA adjacency table with the pairs of a CSV file with
+    fsa and neighbour columns
+    '''
+    from qbay.models import load_fsa_adjacency
+
+    with open(args.file, newline='') as f:
+        count = load_fsa_adjacency(
+            (row['fsa'], row['neighbour']) for row in csv.DictReader(f))
+    print('%i adjacency rows loaded' % count)
+    return 0
+
+
+def migrate(args):
+    '''
+    Shows, applies or reverts the versioned schema migrations
+    '''
+    from qbay import migrations
+    from qbay.models import db
+
+    if args.action == 'status':
+        applied = set(migrations.applied_versions(db.engine))
+        for version, name, _, _ in migrations.MIGRATIONS:
+            print('%s %i %s' % ('*' if version in applied else ' ',
+                                version, name))
+        return 0
+    if args.action == 'upgrade':
+        names = migrations.upgrade(db.engine, args.version)
+    else:
+        if args.version is None:
+            print('downgrade needs the version to go back to')
+            return 1
+        names = migrations.downgrade(db.engine, args.version)
+    for name in names:
+        print('%s: %s' % (args.action, name))
+    print('schema version %i' % migrations.current_version(db.engine))
+    return 0
+
+
+def init_db(args):
+    '''
+    Creates the missing tables and applies the migrations, run once per
+    deploy instead of on every start
+    '''
+    from qbay.models import init_schema
+
+    for name in init_schema():
+        print('upgrade: %s' % name)
+    print('schema ready')
+    return 0
+
+
+def repair_listing_counters(args):
+    '''
+    Recomputes the booking and review counters and the next available
+    date of every listing
+    '''
+    from qbay.models import repair_listing_counters
+
+    print('%i listings repaired' % repair_listing_counters())
+    return 0
+
+
+def shard_bookings(args):
+    '''
+    Moves the bookings of the main database into the booking shards,
+    once after setting booking_shards
+    '''
+    from qbay.models import booking_shards, move_bookings_to_shards
+
+    if not booking_shards():
+        print('bookings are not sharded, set booking_shards first')
+        return 1
+    print('%i bookings moved' % move_bookings_to_shards())
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m qbay.cli')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser(
+        'import-users', help='bulk register users from a CSV file')
+    command.add_argument('file', help='CSV file with name,email,password')
+    command.add_argument('--chunk-size', type=int, default=500,
+                         help='users validated and inserted together')
+    command.add_argument('--rejects',
+                         help='write rejected rows to this CSV file')
+    command.set_defaults(run=import_users)
+
+    command = commands.add_parser(
+        'revoke-sessions', help='end every session of a user')
+    command.add_argument('user_id', type=int)
+    command.set_defaults(run=revoke_sessions)
+
+    command = commands.add_parser(
+        'snapshot-balances', help='record the balance of every user')
+    command.set_defaults(run=snapshot_balances)
+
+    command = commands.add_parser(
+        'load-fsa-adjacency', help='load neighbouring postal code areas')
+    command.add_argument('file', help='CSV file with fsa,neighbour')
+    command.set_defaults(run=load_fsa_adjacency)
+
+    command = commands.add_parser(
+        'migrate', help='show, apply or revert schema migrations')
+    command.add_argument('action', choices=['status', 'upgrade', 'downgrade'])
+    command.add_argument('version', type=int, nargs='?',
+                         help='target version, upgrade defaults to the '
+                              'latest')
+    command.set_defaults(run=migrate)
+
+    command = commands.add_parser(
+        'init-db', help='create the tables and apply the migrations')
+    command.set_defaults(run=init_db)
+
+    command = commands.add_parser(
+        'repair-listing-counters',
+        help='recompute the booking and review counters of listings')
+    command.set_defaults(run=repair_listing_counters)
+
+    command = commands.add_parser(
+        'shard-bookings',
+        help='move the bookings of the main database into the shards')
+    command.set_defaults(run=shard_bookings)
+
+    args = parser.parse_args(argv)
+    from qbay import app
+    with app.app_context():
+        return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,28 @@
-from flask import render_template, request, session, redirect
-from qbay.models import login, User, Listing, register, Booking
+from flask import render_template, request, session, redirect, jsonify
+from qbay.models import login, Listing, register, user_bookings
 from qbay.models import update_listing, create_listing, create_booking
+from qbay.models import update_listings, cached_user, get_listing
+from qbay.models import identity_map_stats, known_emails, listings_near
+from qbay.models import db, ensure_schema, booking_shards
+from qbay.pool import pool_stats
+from qbay.ratelimit import RateLimiter
 from datetime import date, datetime
+from functools import wraps
 
 
 from qbay import app
 
 
+# Login attempts per client IP and per email, checked before any
+# validation or database work
+ip_limiter = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_IP'],
+                         app.config['LOGIN_WINDOW'],
+                         app.config['LOGIN_LIMITER_SIZE'])
+email_limiter = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_EMAIL'],
+                            app.config['LOGIN_WINDOW'],
+                            app.config['LOGIN_LIMITER_SIZE'])
+
+
 def authenticate(inner_function):
     """
     :param inner_function: any python function that accepts a user object
@@ -20,27 +36,62 @@ def authenticate(inner_function):
         pass
     """
 
+    @wraps(inner_function)
     def wrapped_inner():
 
         # check did we store the key in the session
         if 'logged_in' in session:
-            email = session['logged_in']
             try:
-                user = User.query.filter_by(email=email).one_or_none()
-                if user:
-                    # if the user exists, call the inner_function
-                    # with user as parameter
-                    return inner_function(user)
+                # the signed session holds the user id and the user
+                # version it was issued for, recently seen users come
+                # from the session user cache
+                user_id, version = session['logged_in']
+                user = cached_user(user_id, version)
             except Exception:
-                pass
-        else:
-            # else, redirect to the login page
-            return redirect('/login')
+                user = None
+            if user:
+                # if the user exists, call the inner_function
+                # with user as parameter
+                return inner_function(user)
+        # else, redirect to the login page
+        return redirect('/login')
 
     # return the wrapped version of the inner_function:
     return wrapped_inner
 
 
+def remember_login(user):
+    """
+    Stores the user id and the current user version in the session.
+    A profile change bumps the version, which makes every other
+    session of that user stale.
+    """
+    session['logged_in'] = [user.id, user.version]
+
+
+@app.before_request
+def lazy_schema():
+    """
+    Creates the missing tables before the first request of the process,
+    unless the schema is created at deploy time
+    """
+    if app.config['SCHEMA_INIT'] == 'lazy':
+        ensure_schema()
+
+
+@app.after_request
+def identity_map_headers(response):
+    """
+    In debug mode, reports how many lookups of this request were
+    answered by the identity map instead of a query
+    """
+    if app.debug:
+        stats = identity_map_stats()
+        response.headers['X-Identity-Map-Hits'] = str(stats['hits'])
+        response.headers['X-Identity-Map-Misses'] = str(stats['misses'])
+    return response
+
+
 @app.route('/login', methods=['GET'])
 def login_get():
     """
@@ -56,9 +107,17 @@ def login_post():
     """
     email = request.form.get('email')
     password = request.form.get('password')
+
+    # Reject bursts of attempts before any regex or SQL work
+    if app.config['LOGIN_RATE_LIMIT'] and not (
+            ip_limiter.allow(request.remote_addr) and
+            email_limiter.allow(str(email)[:254])):
+        return render_template('login.html',
+                               message='too many login attempts'), 429
+
     user = login(email, password)
     if user:
-        session['logged_in'] = user.email
+        remember_login(user)
         """
         Session is an object that contains sharing information
         between a user's browser and the end server.
@@ -84,8 +143,9 @@ def home(user):
     # the login checking code all the time for other
     # front-end portals
 
-    # Find all bookings that the user booked and display them
-    bookings = Booking.query.filter_by(user_id=user.id).all()
+    # Find all bookings that the user booked and display them, from
+    # every shard when bookings are sharded
+    bookings = user_bookings(user.id)
 
     return render_template('index.html', user=user, bookings=bookings)
 
@@ -126,12 +186,11 @@ def register_post():
 
 
 @app.route('/profile_update', methods=['GET'])
-def profile_update_get():
+@authenticate
+def profile_update_get(user):
     """
     Handles get command for profile update page
     """
-    # access user by quering for the email in the current session
-    user = User.query.filter_by(email=session['logged_in']).first()
     # render the profile_update html page when linked to /profile_update
     username = user.username
     email = user.email
@@ -153,7 +212,8 @@ def profile_update_get():
 
 
 @app.route('/profile_update', methods=['POST'])
-def profile_update_post():
+@authenticate
+def profile_update_post(user):
     """
     Handles post command for profile update page
     """
@@ -166,9 +226,6 @@ def profile_update_post():
     err_msg = 'Invalid Input, Please Try Again!'
     success_msg = 'Profile Updated!'
 
-    # access user by quering for the email in the current session
-    user = User.query.filter_by(email=session['logged_in']).first()
-
     # Update only the text boxes that were filled
     if username == '':
         username = user.username
@@ -183,9 +240,11 @@ def profile_update_post():
     success = user.update_user(username=username, email=email,
                                ship_addr=bill, postal_code=postal)
 
+    # Keep this session valid, any saved change bumped the user version
+    remember_login(user)
+
     # If success render html
     if success:
-        session['logged_in'] = user.email
         return render_template('profile_update.html',
                                message=success_msg,
                                user_name_placeholder=user.username,
@@ -214,7 +273,8 @@ def booking_get():
 
 
 @app.route('/booking', methods=['POST'])
-def booking_post():
+@authenticate
+def booking_post(user):
     """
     Handles post command for booking page
     """
@@ -229,8 +289,6 @@ def booking_post():
     err_msg = 'Invalid Input, Please Try Again!'
     success_msg = 'Listing Booked!'
 
-    # access user by quering for the email in the current session
-    user = User.query.filter_by(email=session['logged_in']).first()
     # access list of listings
     listings = Listing.query.order_by(Listing.id).all()
 
@@ -261,19 +319,22 @@ def create_listing_get():
 
 
 @app.route('/create_listing', methods=['POST'])
-def create_listing_post():
+@authenticate
+def create_listing_post(user):
     """
     Handles post command for create listing page
     """
     title = request.form.get('title')
     description = request.form.get('description')
     price = float(request.form.get('price'))
+    postal_code = request.form.get('postal_code', '')
 
     error_message = None
 
-    user_id = User.query.filter_by(email=session['logged_in']).first().id
+    user_id = user.id
     # use backend api to create listing
-    success = create_listing(title, description, price, date.today(), user_id)
+    success = create_listing(title, description, price, date.today(), user_id,
+                             postal_code=postal_code)
     if not success:
         error_message = "Listing Creation failed."
 
@@ -299,12 +360,13 @@ def logout():
 
 
 @app.route('/listing', methods=['GET'])
-def listing():
+@authenticate
+def listing(user):
     """
     function handling the GET method for /listing
     """
     # Get the id of the logged on user
-    user_id = User.query.filter_by(email=session['logged_in']).first().id
+    user_id = user.id
 
     # Get all listings in database
     listings = Listing.query.filter_by(owner_id=user_id).all()
@@ -314,13 +376,32 @@ def listing():
                            message='Here are all your listings')
 
 
+@app.route('/listing/near', methods=['GET'])
+@authenticate
+def listing_near(user):
+    """
+    function handling the GET method for /listing/near
+    """
+    if not user.postal_code:
+        return render_template('listing_near.html', listings=[],
+                               message='Set a postal code in your profile '
+                                       'to see listings near you')
+
+    # Listings in the user's postal code area and the areas around it
+    listings = listings_near(user)
+    return render_template('listing_near.html', listings=listings,
+                           message='Here are the listings near '
+                                   + user.postal_code[:3])
+
+
 @app.route('/listing/update/<int:id>', methods=['GET'])
 def update_listing_get(id):
     """
     Function for Get commands
     """
-    # Get all listings in database
-    listing = Listing.query.filter_by(id=id).all()
+    # Get the listing with the specific ID
+    listing = get_listing(id)
+    listing = [listing] if listing else []
 
     # Render the template
     return render_template('update_listing.html', listing=listing,
@@ -348,7 +429,7 @@ def update_listing_post(id):
         description = None
 
     # Get the listing with the specific ID
-    listing = Listing.query.filter_by(id=id).first()
+    listing = get_listing(id)
 
     err_message = ''
 
@@ -360,8 +441,10 @@ def update_listing_post(id):
     if not success:
         err_message = "List Update FAILED"
 
-    # Change the listing to reflect changes
-    listing = Listing.query.filter_by(id=id).all()
+    # Change the listing to reflect changes, the second lookup is served
+    # by the request's identity map
+    listing = get_listing(id)
+    listing = [listing] if listing else []
 
     if err_message:
         # If error message is not null render page with fail message
@@ -371,3 +454,48 @@ def update_listing_post(id):
         # If update success update page with success message
         return render_template('update_listing.html', listing=listing,
                                message="List Update PASSED")
+
+
+@app.route('/listing/bulk_update', methods=['POST'])
+@authenticate
+def bulk_update_listing_post(user):
+    """
+    Applies many updates to the logged in user's listings in one
+    transaction. Users have no admin role, so a host updates their own
+    portfolio. Expects a JSON body such as
+    {"changes": [{"id": 1, "price": 120.0}, {"id": 2, "title": "..."}]}
+    and answers with the outcome of every listing id.
+    """
+    payload = request.get_json(silent=True)
+    changes = []
+    if isinstance(payload, dict) and isinstance(payload.get('changes'), list):
+        changes = payload['changes']
+
+    # JSON has no float type for whole numbers
+    for change in changes:
+        if isinstance(change, dict) and isinstance(change.get('price'), int) \
+           and not isinstance(change.get('price'), bool):
+            change['price'] = float(change['price'])
+
+    outcomes = update_listings(changes, owner_id=user.id)
+    return jsonify({str(listing_id): success
+                    for listing_id, success in outcomes.items()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Exposes in-process counters for monitoring
+    """
+    return jsonify({
+        'login_limiter': {
+            'ip': ip_limiter.stats(),
+            'email': email_limiter.stats(),
+        },
+        'email_filter': known_emails.stats(),
+        'db_pool': pool_stats(db.engine.pool),
+        'db_replica_pool': pool_stats(db.engines['replica'].pool)
+        if 'replica' in db.engines else None,
+        'db_booking_shard_pools': [pool_stats(engine.pool)
+                                   for engine in booking_shards()] or None,
+    })
@@ -0,0 +1,375 @@
+from datetime import datetime
+from sqlalchemy import Column, Date, DateTime, Float, ForeignKey, \
+    ForeignKeyConstraint, Index, Integer, MetaData, String, Table, \
+    inspect, select
+from sqlalchemy.schema import AddConstraint, CreateColumn, DropConstraint
+
+
+'''
+This file defines the versioned schema migrations. db.create_all() only
+creates missing tables, so columns and indexes added to existing tables,
+e.g. on the MySQL deployment, are added by these steps instead.
+
+Every step only changes what is missing (or present, when going down),
+so a database created by db.create_all() can be upgraded to record its
+version without errors. The applied versions are kept in the
+schema_migration table.
+
+Usage:
+    python -m qbay.cli migrate status
+    python -m qbay.cli migrate upgrade [version]
+    python -m qbay.cli migrate downgrade <version>
+'''
+
+
+history = Table(
+    'schema_migration', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(120), nullable=False),
+    Column('applied', DateTime, nullable=False))
+
+
+def quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def reflect(connection, table):
+    return Table(table, MetaData(), autoload_with=connection)
+
+
+def add_column(connection, table, column):
+    '''
+    Adds a column to a table unless it is already there
+    '''
+    columns = [c['name'] for c in inspect(connection).get_columns(table)]
+    if column.name not in columns:
+        Table(table, MetaData(), column)
+        spec = CreateColumn(column).compile(dialect=connection.dialect)
+        connection.exec_driver_sql('ALTER TABLE %s ADD COLUMN %s'
+                                   % (quote(connection, table), spec))
+
+
+def drop_column(connection, table, column):
+    '''
+    Drops a column of a table if it is there
+    '''
+    columns = [c['name'] for c in inspect(connection).get_columns(table)]
+    if column in columns:
+        connection.exec_driver_sql('ALTER TABLE %s DROP COLUMN %s'
+                                   % (quote(connection, table),
+                                      quote(connection, column)))
+
+
+def index_names(connection, table):
+    return [index['name'] for index in inspect(connection).get_indexes(table)]
+
+
+def create_index(connection, name, table, *columns):
+    '''
+    Creates an index unless an index of that name exists
+    '''
+    if name not in index_names(connection, table):
+        reflected = reflect(connection, table)
+        Index(name, *[reflected.c[column] for column in columns]) \
+            .create(connection)
+
+
+def drop_index(connection, name, table):
+    '''
+    Drops an index if it exists
+    '''
+    if name in index_names(connection, table):
+        reflected = reflect(connection, table)
+        for index in reflected.indexes:
+            if index.name == name:
+                index.drop(connection)
+
+
+def rebuild_table(connection, table):
+    '''
+    Recreates a SQLite table as table defines it, keeping its rows.
+    SQLite cannot add or drop a constraint of an existing table.
+    '''
+    old = table.name + '_old'
+    for name in index_names(connection, table.name):
+        connection.exec_driver_sql('DROP INDEX %s' % quote(connection, name))
+    connection.exec_driver_sql('ALTER TABLE %s RENAME TO %s'
+                               % (quote(connection, table.name),
+                                  quote(connection, old)))
+    table.create(connection)
+    columns = ', '.join(quote(connection, column.name)
+                        for column in table.columns)
+    connection.exec_driver_sql('INSERT INTO %s (%s) SELECT %s FROM %s'
+                               % (quote(connection, table.name), columns,
+                                  columns, quote(connection, old)))
+    connection.exec_driver_sql('DROP TABLE %s' % quote(connection, old))
+
+
+def foreign_keys(connection, table, column):
+    return [key for key in inspect(connection).get_foreign_keys(table)
+            if key['constrained_columns'] == [column]]
+
+
+def drop_foreign_key(connection, table, column):
+    '''
+    Drops the foreign key of a column if there is one, table defines
+    the table without it
+    '''
+    keys = foreign_keys(connection, table.name, column)
+    if not keys:
+        return
+    if connection.dialect.name == 'sqlite':
+        rebuild_table(connection, table)
+        return
+    reflected = reflect(connection, table.name)
+    for constraint in reflected.foreign_key_constraints:
+        if constraint.name in [key['name'] for key in keys]:
+            connection.execute(DropConstraint(constraint))
+
+
+def add_foreign_key(connection, table, column, target):
+    '''
+    Adds a foreign key to a column unless it has one, table defines the
+    table with it
+    '''
+    if foreign_keys(connection, table.name, column):
+        return
+    if connection.dialect.name == 'sqlite':
+        rebuild_table(connection, table)
+        return
+    metadata = MetaData()
+    reflected = Table(table.name, metadata, autoload_with=connection)
+    Table(target.split('.')[0], metadata, autoload_with=connection)
+    constraint = ForeignKeyConstraint([column], [target])
+    reflected.append_constraint(constraint)
+    connection.execute(AddConstraint(constraint))
+
+
+def create_table(connection, table):
+    table.create(connection, checkfirst=True)
+
+
+def drop_table(connection, table):
+    table.drop(connection, checkfirst=True)
+
+
+# Tables as their migration created them, later changes are steps of
+# their own
+ledger_tables = MetaData()
+ledger_entry = Table(
+    'ledger_entry', ledger_tables,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False,
+           index=True),
+    Column('amount', Float, nullable=False),
+    Column('kind', String(20), nullable=False),
+    Column('booking_id', Integer, ForeignKey('booking.id')),
+    Column('created', DateTime, nullable=False))
+balance_snapshot = Table(
+    'balance_snapshot', ledger_tables,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False,
+           index=True),
+    Column('balance', Float, nullable=False),
+    Column('last_entry_id', Integer, nullable=False),
+    Column('taken', DateTime, nullable=False))
+# the ForeignKeys above resolve against these when creating the tables
+Table('user', ledger_tables, Column('id', Integer, primary_key=True))
+Table('booking', ledger_tables, Column('id', Integer, primary_key=True))
+
+# ledger_entry from migration 7 on, booking_id has no foreign key since
+# the bookings may live in the booking shards
+unlinked_tables = MetaData()
+unlinked_ledger_entry = Table(
+    'ledger_entry', unlinked_tables,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False,
+           index=True),
+    Column('amount', Float, nullable=False),
+    Column('kind', String(20), nullable=False),
+    Column('booking_id', Integer),
+    Column('created', DateTime, nullable=False))
+Table('user', unlinked_tables, Column('id', Integer, primary_key=True))
+
+fsa_adjacency = Table(
+    'fsa_adjacency', MetaData(),
+    Column('fsa', String(3), primary_key=True),
+    Column('neighbour', String(3), primary_key=True))
+
+
+def upgrade_1(connection):
+    add_column(connection, 'user',
+               Column('version', Integer, nullable=False,
+                      server_default='0'))
+
+
+def downgrade_1(connection):
+    drop_column(connection, 'user', 'version')
+
+
+def upgrade_2(connection):
+    create_table(connection, ledger_entry)
+    create_table(connection, balance_snapshot)
+
+
+def downgrade_2(connection):
+    drop_table(connection, balance_snapshot)
+    drop_table(connection, ledger_entry)
+
+
+def upgrade_3(connection):
+    add_column(connection, 'listing',
+               Column('postal_code', String(7), nullable=False,
+                      server_default=''))
+    add_column(connection, 'listing', Column('fsa', String(3)))
+    create_index(connection, 'ix_listing_fsa', 'listing', 'fsa')
+    create_table(connection, fsa_adjacency)
+
+
+def downgrade_3(connection):
+    drop_table(connection, fsa_adjacency)
+    drop_index(connection, 'ix_listing_fsa', 'listing')
+    drop_column(connection, 'listing', 'fsa')
+    drop_column(connection, 'listing', 'postal_code')
+
+
+def upgrade_4(connection):
+    # listing() finds the listings of a user, home() the bookings of a
+    # user, and reviews are read per listing
+    create_index(connection, 'ix_listing_owner_id', 'listing', 'owner_id')
+    create_index(connection, 'ix_booking_user_id', 'booking', 'user_id')
+    create_index(connection, 'ix_review_listing_id', 'review', 'listing_id')
+
+
+def downgrade_4(connection):
+    drop_index(connection, 'ix_review_listing_id', 'review')
+    drop_index(connection, 'ix_booking_user_id', 'booking')
+    drop_index(connection, 'ix_listing_owner_id', 'listing')
+
+
+def upgrade_5(connection):
+    # create_booking looks for stays of a listing overlapping a date
+    # range, which this index answers without reading the table
+    create_index(connection, 'ix_booking_listing_dates', 'booking',
+                 'listing_id', 'start_date', 'end_date')
+
+
+def downgrade_5(connection):
+    drop_index(connection, 'ix_booking_listing_dates', 'booking')
+
+
+def upgrade_6(connection):
+    # the values of existing listings are filled in by
+    # 'python -m qbay.cli repair-listing-counters'
+    add_column(connection, 'listing',
+               Column('booking_count', Integer, nullable=False,
+                      server_default='0'))
+    add_column(connection, 'listing',
+               Column('review_count', Integer, nullable=False,
+                      server_default='0'))
+    add_column(connection, 'listing', Column('next_available_date', Date))
+
+
+def downgrade_6(connection):
+    drop_column(connection, 'listing', 'next_available_date')
+    drop_column(connection, 'listing', 'review_count')
+    drop_column(connection, 'listing', 'booking_count')
+
+
+def upgrade_7(connection):
+    drop_foreign_key(connection, unlinked_ledger_entry, 'booking_id')
+
+
+def downgrade_7(connection):
+    add_foreign_key(connection, ledger_entry, 'booking_id', 'booking.id')
+
+
+def upgrade_8(connection):
+    # users from before have no time, the email filters load them when
+    # they are rebuilt
+    add_column(connection, 'user', Column('email_changed', DateTime))
+    create_index(connection, 'ix_user_email_changed', 'user',
+                 'email_changed')
+
+
+def downgrade_8(connection):
+    drop_index(connection, 'ix_user_email_changed', 'user')
+    drop_column(connection, 'user', 'email_changed')
+
+
+# (version, name, upgrade, downgrade), in order
+MIGRATIONS = [
+    (1, 'add user.version', upgrade_1, downgrade_1),
+    (2, 'add ledger tables', upgrade_2, downgrade_2),
+    (3, 'add listing postal codes', upgrade_3, downgrade_3),
+    (4, 'add foreign key indexes', upgrade_4, downgrade_4),
+    (5, 'add booking date range index', upgrade_5, downgrade_5),
+    (6, 'add listing counters', upgrade_6, downgrade_6),
+    (7, 'drop ledger booking foreign key', upgrade_7, downgrade_7),
+    (8, 'add user email change time', upgrade_8, downgrade_8),
+]
+HEAD = MIGRATIONS[-1][0]
+
+
+def applied_versions(engine):
+    '''
+    Returns the versions applied to a database, in order
+    '''
+    with engine.begin() as connection:
+        create_table(connection, history)
+        return [version for (version,) in connection.execute(
+            select(history.c.version).order_by(history.c.version))]
+
+
+def current_version(engine):
+    '''
+    Returns the schema version of a database, 0 if nothing was applied
+    '''
+    versions = applied_versions(engine)
+    return versions[-1] if versions else 0
+
+
+def upgrade(engine, target=None):
+    '''
+    Applies the migrations missing from a database
+      Parameters:
+        engine (Engine):     database to migrate
+        target (int):        last version to apply, defaults to HEAD
+      Returns:
+        The names of the applied migrations
+    '''
+    target = HEAD if target is None else target
+    applied = set(applied_versions(engine))
+    names = []
+    for version, name, step, _ in MIGRATIONS:
+        if version > target or version in applied:
+            continue
+        # one transaction per step, MySQL commits DDL right away anyway
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(history.insert().values(
+                version=version, name=name, applied=datetime.utcnow()))
+        names.append(name)
+    return names
+
+
+def downgrade(engine, target):
+    '''
+    Reverts the migrations applied after a version
+      Parameters:
+        engine (Engine):     database to migrate
+        target (int):        version to go back to, 0 reverts everything
+      Returns:
+        The names of the reverted migrations
+    '''
+    applied = set(applied_versions(engine))
+    names = []
+    for version, name, _, step in reversed(MIGRATIONS):
+        if version <= target or version not in applied:
+            continue
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(history.delete().where(
+                history.c.version == version))
+        names.append(name)
+    return names
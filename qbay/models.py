@@ -1,8 +1,24 @@
-import re
-import string
+import heapq
+import threading
+import time
 from qbay import app
+from flask import g
+from qbay.bloom import BloomFilter
+from qbay.cache import LRUCache
+from qbay.passwords import hash_password, hash_passwords, \
+    verify_password, needs_rehash
+from qbay import migrations, validation
+from qbay.pool import sqlite_pragmas, tune_sqlite
+from qbay.queries import count_queries
+from qbay.replica import RoutingSession, route_reads
+from qbay import shards
 from flask_sqlalchemy import SQLAlchemy
-from datetime import date
+from sqlalchemy import and_, bindparam, case, delete, exists, insert, \
+    inspect, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from datetime import date, datetime, timedelta
 
 
 '''
@@ -10,7 +26,22 @@ This file defines data models and related business logics
 '''
 
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+route_reads(app)
+# creating the engines does not connect yet
+with app.app_context():
+    if app.config['SQLITE_PROFILE'] == 'tuned':
+        for engine in db.engines.values():
+            tune_sqlite(engine, sqlite_pragmas(app.config))
+    count_queries(app, db.engines.values())
+
+# R1-10 Balance should be initialized as 100
+OPENING_BALANCE = 100
+
+# Recently authenticated users keyed by user id, entries are refreshed
+# whenever the user changes and expire after a short TTL
+user_cache = LRUCache(app.config.get('USER_CACHE_SIZE', 1024),
+                      app.config.get('USER_CACHE_TTL', 30))
 
 
 class User(db.Model):
@@ -24,6 +55,10 @@ class User(db.Model):
         ship_addr (String):        user ship address
         postal_code (String):      user postal code
         balance (Integer):         user balance
+        version (Integer):         bumped on every profile change, a
+                                   session of an older version is stale
+        email_changed (DateTime):  time the email was registered or last
+                                   changed, see KnownEmails
     '''
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(
@@ -37,90 +72,112 @@ class User(db.Model):
     postal_code = db.Column(
         db.String(120), nullable=False, default='')
     balance = db.Column(
-        db.Float, nullable=False, default=100)
+        db.Float, nullable=False, default=OPENING_BALANCE)
+    version = db.Column(
+        db.Integer, nullable=False, default=0)
+    email_changed = db.Column(
+        db.DateTime, default=datetime.utcnow, index=True)
 
     def __repr__(self):
         return '<ID %r>' % self.id
 
+    def save(self):
+        '''
+        Commits a profile change, bumping the version so older sessions
+        become stale, and refreshes the session user cache.
+        '''
+        self.version = (self.version or 0) + 1
+        snapshot = detached_copy(self) if self.id is not None else None
+        db.session.commit()
+        if snapshot is not None:
+            user_cache.set(self.id, snapshot)
+
     def update_user(self, username: str = None, email: str = None,
                     ship_addr: str = None, postal_code: str = None):
         '''
         Updates user properties.
+        Every given field is validated first, nothing is written unless
+        all of them are valid, and the changed columns are saved with a
+        single commit.
         '''
-        ut = et = st = pt = True
+        changes = {}
         if username:
-            ut = self.update_name(username)
+            if not self.valid_name(username):
+                return False
+            changes['username'] = username
         if email:
-            et = self.update_email(email)
+            if not self.valid_email(email):
+                return False
+            changes['email'] = email
         if ship_addr:
-            st = self.update_address(ship_addr)
+            changes['ship_addr'] = ship_addr
         if postal_code:
-            pt = self.update_postal_code(postal_code)
+            if not self.valid_postal_code(postal_code):
+                return False
+            changes['postal_code'] = postal_code
 
-        if ut and et and st and pt:
+        return self.apply_changes(changes)
+
+    def apply_changes(self, changes):
+        '''
+        Writes the columns of changes that differ from the current
+        values with one commit.
+        Returns False if the database rejected the change.
+        '''
+        dirty = {column: value for column, value in changes.items()
+                 if getattr(self, column) != value}
+        if not dirty:
             return True
-        else:
+
+        for column, value in dirty.items():
+            setattr(self, column, value)
+        if 'email' in dirty:
+            # lets the email filters of other processes catch up
+            self.email_changed = datetime.utcnow()
+        try:
+            self.save()
+        except IntegrityError:
+            # e.g. the new email is already taken
+            db.session.rollback()
             return False
+        if 'email' in dirty:
+            known_emails.add(dirty['email'])
+        return True
+
+    # R1-5/R1-6, R1-1/R1-3 and R3-2/R3-3 checks shared with register
+    valid_name = staticmethod(validation.valid_name)
+    valid_email = staticmethod(validation.valid_email)
+    valid_postal_code = staticmethod(validation.valid_postal_code)
 
     def update_name(self, name):
         '''
         A user is able to update his/her user name.
         '''
-        # R1-5 Username has to be non-empty
-        if name == '':
-            return False
-
-        # R1-5 Alpahnumerical, and space allowed only as not prefix/suffix
-        name_validation = re.compile('^(?! )[A-Za-z0-9 ]*(?<! )$')
-        if not re.fullmatch(name_validation, name):
-            return False
-
-        # R1-6 Username has to be longer than 2 but shorter than 20
-        if len(name) < 3:
-            return False
-        elif len(name) > 19:
+        if not self.valid_name(name):
             return False
-
-        self.username = name
-        db.session.commit()
-        return True
+        return self.apply_changes({'username': name})
 
     def update_email(self, email):
         '''
         A user is able to update his/her user email.
         '''
-        # R1-1 check if the email is empty
-        if not email:
-            return False
-        # R1-3 The email has to follow addr-spec defined in RFC 5322
-        email_val = re.compile(
-            r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(.[A-Z|a-z]{2,})+')
-        if not re.fullmatch(email_val, email):
+        if not self.valid_email(email):
             return False
-
-        self.email = email
-        db.session.commit()
-        return True
+        return self.apply_changes({'email': email})
 
     def update_address(self, address):
         '''
         A user is able to update his/her billing address.
         '''
-        self.ship_addr = address
-        db.session.commit()
-        return True
+        return self.apply_changes({'ship_addr': address})
 
     def update_postal_code(self, postal_code):
         '''
         A user is able to update his/her postal code.
         '''
-        canadian_postal_code = re.compile('[A-Z][0-9][A-Z] [0-9][A-Z][0-9]')
-        if not re.fullmatch(canadian_postal_code, postal_code):
+        if not self.valid_postal_code(postal_code):
             return False
-
-        self.postal_code = postal_code
-        db.session.commit()
-        return True
+        return self.apply_changes({'postal_code': postal_code})
 
 
 class Review(db.Model):
@@ -138,7 +195,8 @@ class Review(db.Model):
     user_id = db.Column(
         db.Integer, db.ForeignKey('user.id'), nullable=False)
     listing_id = db.Column(
-        db.Integer, db.ForeignKey('listing.id'), nullable=False)
+        db.Integer, db.ForeignKey('listing.id'), nullable=False,
+        index=True)
     review_text = db.Column(
         db.String(2000), nullable=False)
     date = db.Column(
@@ -158,6 +216,17 @@ class Listing(db.Model):
         price (Decimal):           listing price
         last_modified_date (Date): last modified date of listing
         owner_id (Integer):        listing owner's id
+        postal_code (String):      postal code of the listing
+        fsa (String):              forward sortation area, the first
+                                   three characters of the postal code
+        booking_count (Integer):   number of bookings
+        review_count (Integer):    number of reviews
+        next_available_date (Date): first day after the last booked
+                                   stay, None without bookings
+
+    The counters and next_available_date are kept up to date by
+    create_booking and create_review, and recomputed by
+    repair_listing_counters.
     '''
     id = db.Column(
         db.Integer, primary_key=True)
@@ -170,12 +239,48 @@ class Listing(db.Model):
     last_modified_date = db.Column(
         db.Date)
     owner_id = db.Column(
-        db.Integer, db.ForeignKey('user.id'), nullable=False)
+        db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    postal_code = db.Column(
+        db.String(7), nullable=False, default='')
+    fsa = db.Column(
+        db.String(3), index=True)
+    booking_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    review_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    next_available_date = db.Column(
+        db.Date)
+
+    @property
+    def booked_until(self):
+        '''
+        Returns the last day of the latest booked stay, None without
+        bookings. Earlier days may still be free between stays.
+        '''
+        if self.next_available_date is None:
+            return None
+        return self.next_available_date - timedelta(days=1)
 
     def __repr__(self):
         return '<Listing %r>' % self.title
 
 
+class FsaAdjacency(db.Model):
+    '''
+    Precomputed neighbours of a forward sortation area
+      Attributes:
+        fsa (String):              forward sortation area
+        neighbour (String):        an adjacent forward sortation area
+    '''
+    fsa = db.Column(
+        db.String(3), primary_key=True)
+    neighbour = db.Column(
+        db.String(3), primary_key=True)
+
+    def __repr__(self):
+        return '<FsaAdjacency %r-%r>' % (self.fsa, self.neighbour)
+
+
 class Booking(db.Model):
     '''
     Booking model
@@ -187,8 +292,15 @@ class Booking(db.Model):
         start_date (Date)          start date of stay
         end_date (Date)            end date of stay
     '''
+    # stays of a listing overlapping a date range, see create_booking
+    __table_args__ = (
+        db.Index('ix_booking_listing_dates',
+                 'listing_id', 'start_date', 'end_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False, index=True)
     listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'),
                            nullable=False)
     booking_date = db.Column(db.Date, default=date.today())
@@ -197,6 +309,186 @@ class Booking(db.Model):
 
     def __repr__(self):
         return '<Booking %r>' % self.id
+
+
+class LedgerEntry(db.Model):
+    '''
+    Ledger entry model, rows are only ever appended
+      Attributes:
+        id (Integer):              entry id, increases with time
+        user_id (Integer):         id of the user whose balance changed
+        amount (Float):            credit if positive, debit if negative
+        kind (String):             reason, e.g. 'booking' or 'payout'
+        booking_id (Integer):      booking that caused the entry
+        created (DateTime):        time of the entry
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    # no foreign key, the booking may live in a booking shard
+    booking_id = db.Column(db.Integer)
+    created = db.Column(db.DateTime, nullable=False,
+                        default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<LedgerEntry %r>' % self.id
+
+
+class BalanceSnapshot(db.Model):
+    '''
+    Balance snapshot model
+      Attributes:
+        id (Integer):              snapshot id
+        user_id (Integer):         user id
+        balance (Float):           balance including every ledger entry
+                                   up to last_entry_id
+        last_entry_id (Integer):   last ledger entry id covered
+        taken (DateTime):          time of the snapshot
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False, index=True)
+    balance = db.Column(db.Float, nullable=False)
+    last_entry_id = db.Column(db.Integer, nullable=False, default=0)
+    taken = db.Column(db.DateTime, nullable=False,
+                      default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<BalanceSnapshot %r>' % self.id
+
+
+# Statements of the hot lookups, built once. Their values are bound at
+# execution, so each call finds the compiled SQL in SQLAlchemy's cache
+# without building the statement and its cache key again.
+USER_BY_ID = select(User).where(User.id == bindparam('value'))
+USER_BY_EMAIL = select(User).where(User.email == bindparam('value'))
+LISTING_BY_ID = select(Listing).where(Listing.id == bindparam('value'))
+# a stay of the listing containing start_date or end_date
+BOOKING_OVERLAP = select(Booking.id).where(
+    Booking.listing_id == bindparam('listing_id'),
+    Booking.start_date <= bindparam('end_date'),
+    or_(and_(Booking.start_date <= bindparam('start_date'),
+             Booking.end_date >= bindparam('start_date')),
+        and_(Booking.start_date <= bindparam('end_date'),
+             Booking.end_date >= bindparam('end_date')))).limit(1)
+TITLE_EXISTS = select(exists().where(Listing.title == bindparam('title')))
+OWNER_TITLE_EXISTS = select(exists().where(
+    Listing.title == bindparam('title'),
+    Listing.owner_id == bindparam('owner_id')))
+
+# lookups understood by find_one and lookup
+LOOKUPS = {
+    (User, 'id'): USER_BY_ID,
+    (User, 'email'): USER_BY_EMAIL,
+    (Listing, 'id'): LISTING_BY_ID,
+}
+
+
+def lookup(model, column, value):
+    '''
+    Loads one instance with the cached statement of a lookup, a loaded
+    instance already in the session is returned by id without a query
+      Parameters:
+        model:             model class
+        column (string):   column of a LOOKUPS entry
+        value:             value to look for
+      Returns:
+        The instance otherwise None
+    '''
+    if column == 'id':
+        # An instance marked for deletion stays in the identity map until
+        # the flush, and an expired one would be reloaded by a query of
+        # its own, the statement below refreshes it instead
+        instance = db.session.identity_map.get(identity_key(model, value))
+        if instance is not None:
+            state = inspect(instance)
+            if not (state.deleted or state.detached or
+                    state.expired_attributes or
+                    instance in db.session.deleted):
+                return instance
+    return db.session.scalars(LOOKUPS[model, column],
+                              {'value': value}).first()
+
+
+def transfer(user_id, amount, kind, booking_id=None, require_funds=False):
+    '''
+    Changes a materialized balance and appends the matching ledger entry
+    in the current transaction, the caller commits
+      Attributes:
+        user_id (int):             user id
+        amount (float):            credit if positive, debit if negative
+        kind (str):                reason of the entry
+        booking_id (int):          booking that caused the entry
+        require_funds (bool):      refuse a debit bigger than the balance
+      Returns:
+        True if the balance was changed otherwise False
+    '''
+    # A single conditional UPDATE, so concurrent debits cannot both
+    # spend the same money
+    statement = update(User).where(User.id == user_id)
+    if require_funds:
+        statement = statement.where(User.balance >= -amount)
+    result = db.session.execute(
+        statement.values(balance=User.balance + amount)
+        .execution_options(synchronize_session=False))
+    if result.rowcount != 1:
+        return False
+
+    db.session.add(LedgerEntry(user_id=user_id, amount=amount, kind=kind,
+                               booking_id=booking_id))
+    user_cache.pop(user_id)
+    return True
+
+
+def snapshot_balances():
+    '''
+    Records the balance of every user, so audits only replay the ledger
+    entries written after the snapshot
+      Returns:
+        The number of snapshots taken
+    '''
+    # The balances and the last ledger entry are read by one statement,
+    # so both come from the same snapshot of the database. Separate
+    # reads would let a transfer committed in between count twice.
+    last_entry_id = select(db.func.coalesce(
+        db.func.max(LedgerEntry.id), 0)).scalar_subquery()
+    taken = datetime.utcnow()
+    rows = [{'user_id': user_id, 'balance': balance,
+             'last_entry_id': last_entry_id, 'taken': taken}
+            for user_id, balance, last_entry_id in db.session.execute(
+                select(User.id, User.balance, last_entry_id))]
+    if rows:
+        db.session.execute(insert(BalanceSnapshot), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def audit_balance(user_id):
+    '''
+    Recomputes a balance from the latest snapshot and the ledger
+      Attributes:
+        user_id (int):             user id
+      Returns:
+        A tuple of the recomputed and the materialized balance, they
+        are equal unless the balance was changed outside the ledger
+    '''
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    snapshot = BalanceSnapshot.query.filter_by(user_id=user_id) \
+        .order_by(BalanceSnapshot.id.desc()).first()
+    if snapshot is None:
+        # R1-10 every balance starts at 100
+        start, last_entry_id = OPENING_BALANCE, 0
+    else:
+        start, last_entry_id = snapshot.balance, snapshot.last_entry_id
+    replayed = db.session.query(
+        db.func.coalesce(db.func.sum(LedgerEntry.amount), 0)
+    ).filter(LedgerEntry.user_id == user_id,
+             LedgerEntry.id > last_entry_id).scalar()
+    return start + replayed, user.balance
     
     
 def create_booking(user_id: int, listing_id: int, 
@@ -229,7 +521,7 @@ def create_booking(user_id: int, listing_id: int,
     if start_date > end_date:
         return None
     
-    listing = Listing.query.filter_by(id=listing_id).first()
+    listing = get_listing(listing_id)
     
     # listing does not exist
     if listing is None:
@@ -239,7 +531,7 @@ def create_booking(user_id: int, listing_id: int,
     if user_id == listing.owner_id:
         return None
     
-    user = User.query.filter_by(id=user_id).first()
+    user = get_user(user_id)
     
     # user does not exist
     if user is None:
@@ -249,110 +541,656 @@ def create_booking(user_id: int, listing_id: int,
     if listing.price > user.balance:
         return None
     
-    bookings = Booking.query.filter_by(listing_id=listing_id).all()
-    
-    # check for date overlaps
-    for book in bookings:
-        if start_date >= book.start_date and \
-           start_date <= book.end_date:
-            return None
-        
-        if end_date >= book.start_date and \
-           end_date <= book.end_date:
-            return None
+    values = {'user_id': user_id, 'listing_id': listing_id,
+              'booking_date': date.today(), 'start_date': start_date,
+              'end_date': end_date}
+    engines = booking_shards()
+    if engines:
+        # the shard checks for date overlaps and inserts in one
+        # statement, and holds the booking in its transaction until the
+        # payment is committed, so a refused payment leaves no booking
+        shard = shards.shard_index(listing_id, len(engines))
+        with engines[shard].connect() as connection:
+            booking_id = shards.insert_booking(connection, shard,
+                                               len(engines), values)
+            if booking_id is None or \
+               not pay_for_booking(listing, booking_id, user_id, end_date):
+                connection.rollback()
+                return None
+            try:
+                connection.commit()
+            except SQLAlchemyError:
+                # the payment is committed already, so it is reversed
+                refund_booking(listing, booking_id, user_id)
+                return None
+        booking = Booking(id=booking_id, **values)
+        make_transient_to_detached(booking)
+        return booking
+
+    # check for date overlaps: a stay containing the start or the end
+    # date. Both start before end_date, which bounds the range read from
+    # ix_booking_listing_dates.
+    overlap = db.session.scalar(BOOKING_OVERLAP, {
+        'listing_id': listing_id, 'start_date': start_date,
+        'end_date': end_date})
+    if overlap is not None:
+        return None
     
     # create booking object
-    booking = Booking(user_id=user_id, listing_id=listing_id, 
-                      booking_date=date.today(), start_date=start_date,
-                      end_date=end_date)
+    booking = Booking(**values)
     
     # add it to the current database session
     db.session.add(booking)
-    # actually save the user object
-    db.session.commit()
+    db.session.flush()
 
+    if not pay_for_booking(listing, booking.id, user_id, end_date):
+        return None
     return booking
-    
 
-# create all tables
-db.create_all()
+
+def pay_for_booking(listing, booking_id, user_id, end_date):
+    '''
+    Counts a new booking on its listing and pays the host, then commits
+    the main database
+      Attributes:
+        listing (Listing):     booked listing
+        booking_id (int):      booking id
+        user_id (int):         id of the guest
+        end_date (date):       end date of the stay
+      Returns:
+        True if the guest could pay otherwise False, after rolling back
+    '''
+    # count the booking on the listing in the same transaction, as an
+    # increment so concurrent bookings are not lost. The commit below
+    # expires the loaded listing, so it is not synchronized here.
+    after_stay = end_date + timedelta(days=1)
+    db.session.execute(
+        update(Listing).where(Listing.id == listing.id).values(
+            booking_count=Listing.booking_count + 1,
+            next_available_date=case(
+                (or_(Listing.next_available_date.is_(None),
+                     Listing.next_available_date < after_stay),
+                 after_stay),
+                else_=Listing.next_available_date)),
+        execution_options={'synchronize_session': False})
+
+    # pay the host in the same transaction, the debit is refused if a
+    # concurrent booking spent the money first
+    price = listing.price
+    if not transfer(user_id, -price, 'booking', booking_id,
+                    require_funds=True):
+        db.session.rollback()
+        return False
+    transfer(listing.owner_id, price, 'payout', booking_id)
+
+    # actually save the booking and the ledger entries
+    db.session.commit()
+    return True
 
 
-def update_listing(listing, title=None, description=None, price=None):
+def refund_booking(listing, booking_id, user_id):
     '''
-    Updates a listing
+    Reverses the payment and the count of a booking whose shard could
+    not save it, then commits the main database
       Attributes:
-        listing (Listing)          Listing object
-        title (str):               listing title (optional)
-        description (str):         listing description (optional)
-        price (float):             listing price (optional)
+        listing (Listing):     booked listing
+        booking_id (int):      id the booking would have had
+        user_id (int):         id of the guest
+    '''
+    db.session.rollback()
+    price = listing.price
+    transfer(user_id, price, 'refund', booking_id)
+    transfer(listing.owner_id, -price, 'payout reversal', booking_id)
+    # next_available_date may stay a little late, the repair of the
+    # listing counters recomputes it
+    db.session.execute(
+        update(Listing).where(Listing.id == listing.id).values(
+            booking_count=Listing.booking_count - 1),
+        execution_options={'synchronize_session': False})
+    db.session.commit()
+
+
+def booking_shards():
+    '''
+    Returns the engines of the booking shards, empty unless bookings
+    are sharded
+    '''
+    return shards.shard_engines(db.engines, app.config['BOOKING_SHARDS'])
+
+
+def user_bookings(user_id):
+    '''
+    Returns the bookings of a user in id order. With booking shards they
+    are read from every shard in parallel and returned detached.
+    '''
+    engines = booking_shards()
+    if not engines:
+        return Booking.query.filter_by(user_id=user_id) \
+            .order_by(Booking.id).all()
+    bookings = []
+    # every shard answers in id order, so merging keeps the order
+    for row in heapq.merge(*shards.fan_out(engines, shards.USER_BOOKINGS,
+                                           {'user_id': user_id})):
+        booking = Booking(**row._mapping)
+        make_transient_to_detached(booking)
+        bookings.append(booking)
+    return bookings
+
+
+def booking_totals():
+    '''
+    Returns the number of bookings and the end of the last stay of every
+    booked listing, as a dict keyed by listing id
+    '''
+    engines = booking_shards()
+    if not engines:
+        # the shard table has the columns of the main booking table
+        rows = db.session.execute(shards.BOOKING_TOTALS).all()
+    else:
+        # a listing books in a single shard, so no totals overlap
+        rows = [row for rows in shards.fan_out(engines,
+                                               shards.BOOKING_TOTALS)
+                for row in rows]
+    return {listing_id: (count, last) for listing_id, count, last in rows}
+    
+
+def create_review(user_id: int, listing_id: int, review_text: str):
+    '''
+    Creates a review of a listing
+      Attributes:
+        user_id (int)          id of the reviewer
+        listing_id (int):      listing id
+        review_text (str):     review text, at most 2000 characters
       Returns:
-        The listing object if succeeded otherwise None
+        The review object if succeeded otherwise None
     '''
+    if not isinstance(review_text, str) or \
+       not 0 < len(review_text) <= 2000:
+        return None
 
-    # If all three optional arguments are skipped
-    if title is None and description is None and price is None:
+    listing = get_listing(listing_id)
+    if listing is None or get_user(user_id) is None:
         return None
 
-    # If listing is not of instance Listing
-    if not isinstance(listing, Listing):
+    # cannot review user's own listing
+    if user_id == listing.owner_id:
         return None
 
-    # If title was given
-    if title is not None:
+    review = Review(user_id=user_id, listing_id=listing_id,
+                    review_text=review_text, date=date.today())
+    db.session.add(review)
 
-        # If title is of instance str
-        if not isinstance(title, str):
-            return None
+    # count the review in the same transaction
+    db.session.execute(
+        update(Listing).where(Listing.id == listing_id).values(
+            review_count=Listing.review_count + 1),
+        execution_options={'synchronize_session': False})
+    db.session.commit()
+    return review
+
+
+def repair_listing_counters():
+    '''
+    Recomputes booking_count, review_count and next_available_date of
+    every listing from the bookings and reviews
+      Returns:
+        The number of listings whose values were wrong
+    '''
+    reviews = select(db.func.count(Review.id)).where(
+        Review.listing_id == Listing.id).scalar_subquery()
+    totals = booking_totals()
+
+    # compare first, so the repair reports the drift it fixed
+    rows = db.session.query(Listing.id, Listing.booking_count,
+                            Listing.review_count,
+                            Listing.next_available_date, reviews).all()
+    wrong = 0
+    for listing_id, booking_count, review_count, available, \
+            reviewed in rows:
+        booked, last = totals.get(listing_id, (0, None))
+        expected = last + timedelta(days=1) if last else None
+        if (booking_count, review_count, available) != \
+           (booked, reviewed, expected):
+            wrong += 1
+
+    # The reviews in one statement. The bookings may live in the shards
+    # and the dates need date arithmetic that differs between databases,
+    # so the booked listings are written by primary key.
+    db.session.execute(
+        update(Listing).values(booking_count=0, review_count=reviews,
+                               next_available_date=None),
+        execution_options={'synchronize_session': False})
+    listings = {listing_id for listing_id, *_ in rows}
+    booked = [{'id': listing_id, 'booking_count': count,
+               'next_available_date': last + timedelta(days=1)}
+              for listing_id, (count, last) in totals.items()
+              if listing_id in listings]
+    if booked:
+        db.session.execute(update(Listing), booked)
+    db.session.commit()
+    return wrong
+
+
+# set once the tables of this process' database are known to exist
+schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def init_schema():
+    '''
+    Creates the missing tables and records the migrations they include,
+    the one-time deploy step behind 'python -m qbay.cli init-db'
+      Returns:
+        The names of the migrations applied
+    '''
+    global schema_ready
+    db.create_all()
+    names = migrations.upgrade(db.engine)
+    prepare_shards()
+    schema_ready = True
+    return names
+
+
+def ensure_schema():
+    '''
+    Creates the missing tables once per process, for SCHEMA_INIT 'lazy'
+    '''
+    global schema_ready
+    if schema_ready:
+        return
+    with _schema_lock:
+        if not schema_ready:
+            db.create_all()
+            prepare_shards()
+            schema_ready = True
+
+
+def booking_id_base():
+    '''
+    Returns the largest booking id used in the main database, by a
+    booking or by the ledger
+    '''
+    return max(db.session.scalar(select(db.func.max(Booking.id))) or 0,
+               db.session.scalar(select(db.func.max(LedgerEntry.booking_id)))
+               or 0)
+
+
+def prepare_shards():
+    '''
+    Creates the tables of the booking shards. Bookings left in the main
+    database would be invisible to the shards, so the app refuses to
+    start until they are moved.
+    '''
+    engines = booking_shards()
+    if not engines:
+        return
+    shards.create_shards(engines, booking_id_base())
+    left = db.session.scalar(select(db.func.count(Booking.id)))
+    db.session.commit()
+    if left:
+        raise RuntimeError(
+            '%i bookings are still in the main database, move them with '
+            "'python -m qbay.cli shard-bookings'" % left)
+
+
+def move_bookings_to_shards():
+    '''
+    Moves the bookings of the main database into the shards of their
+    listings, keeping their ids. A move that was interrupted can be run
+    again.
+      Returns:
+        The number of bookings moved
+    '''
+    engines = booking_shards()
+    shards.create_shards(engines, booking_id_base())
+    rows = db.session.execute(select(Booking.__table__)).all()
+    bases = [shards.id_base(engine) for engine in engines]
+    if rows and max(row.id for row in rows) > min(bases):
+        # the shards may have handed out these ids already
+        raise RuntimeError('bookings were made in the main database after '
+                           'the shards were created')
+    by_shard = {}
+    for row in rows:
+        shard = shards.shard_index(row.listing_id, len(engines))
+        by_shard.setdefault(shard, []).append(dict(row._mapping))
+    for shard, moved in by_shard.items():
+        with engines[shard].begin() as connection:
+            for start in range(0, len(moved), 500):
+                chunk = moved[start:start + 500]
+                copied = set(connection.scalars(
+                    select(shards.booking.c.id).where(
+                        shards.booking.c.id.in_(
+                            [booking['id'] for booking in chunk]))))
+                missing = [booking for booking in chunk
+                           if booking['id'] not in copied]
+                if missing:
+                    connection.execute(shards.booking.insert(), missing)
+    # only deleted once every shard has its copy, no booking is made in
+    # the main database meanwhile as the app refuses to start
+    if rows:
+        db.session.execute(delete(Booking).where(
+            Booking.id <= max(row.id for row in rows)))
+    db.session.commit()
+    return len(rows)
+
+
+def detached_copy(instance):
+    '''
+    Returns a copy of a model instance that belongs to no session, so it
+    can be kept between requests and merged back without a query
+    '''
+    model = type(instance)
+    copy = model(**{column.key: getattr(instance, column.key)
+                    for column in model.__table__.columns})
+    make_transient_to_detached(copy)
+    return copy
+
+
+def identity_map():
+    '''
+    Returns the identity map of the current request, created on first
+    use. It maps (model name, column, value) to a loaded instance and
+    keeps at most IDENTITY_MAP_SIZE of them, as code outside requests,
+    e.g. the CLI, may run long in one app context.
+    '''
+    if 'identity_map' not in g:
+        g.identity_map = LRUCache(app.config.get('IDENTITY_MAP_SIZE', 256))
+        g.identity_map_hits = 0
+        g.identity_map_misses = 0
+    return g.identity_map
+
+
+def identity_map_stats():
+    '''
+    Returns the identity map counters of the current request, hits are
+    lookups answered without a query
+    '''
+    identity_map()
+    return {'hits': g.identity_map_hits, 'misses': g.identity_map_misses}
+
+
+def remember(instance):
+    '''
+    Adds a loaded instance to the identity map of the current request
+    '''
+    name = type(instance).__name__
+    identity_map().set((name, 'id', instance.id), instance)
+    return instance
 
-        # If title is a empty str
-        if title == "":
-            return None
 
-        # Satisfy R4-2
-        if len(title) > 80:
+def find_one(model, column, value):
+    '''
+    Finds one instance by a unique column, returning the instance loaded
+    earlier in the same request when there is one
+      Parameters:
+        model:             model class
+        column (string):   unique column with an entry in LOOKUPS
+        value:             value to look for
+      Returns:
+        The instance otherwise None
+    '''
+    if not isinstance(value, (int, str)):
+        return None
+    memo = identity_map()
+    key = (model.__name__, column, value)
+
+    # Reuse the instance if it still belongs to the session, was not
+    # expired by a commit (reading it would query again) and still has
+    # that value (an email may have changed since)
+    instance = memo.get(key)
+    if instance is not None and instance in db.session and \
+       not inspect(instance).expired_attributes and \
+       getattr(instance, column) == value:
+        g.identity_map_hits += 1
+        return instance
+
+    g.identity_map_misses += 1
+    instance = lookup(model, column, value)
+    if instance is None:
+        memo.pop(key, None)
+        return None
+    memo.set(key, instance)
+    return remember(instance)
+
+
+def get_user(user_id):
+    '''
+    Finds a user by id, memoized for the current request
+    '''
+    return find_one(User, 'id', user_id)
+
+
+def get_user_by_email(email):
+    '''
+    Finds a user by email, memoized for the current request
+    '''
+    return find_one(User, 'email', email)
+
+
+def get_listing(listing_id):
+    '''
+    Finds a listing by id, memoized for the current request
+    '''
+    return find_one(Listing, 'id', listing_id)
+
+
+def cached_user(user_id, version=None):
+    '''
+    Finds the user of a session through the session user cache
+      Parameters:
+        user_id (int):     user id stored in the session
+        version (int):     user version stored in the session (optional)
+      Returns:
+        The user object attached to the current session, None if the
+        user does not exist or the session version is stale
+    '''
+    snapshot = user_cache.get(user_id)
+
+    # A newer session than the cached copy means the copy is stale
+    if snapshot is None or \
+       (version is not None and snapshot.version < version):
+        user = lookup(User, 'id', user_id)
+        if user is None:
+            user_cache.pop(user_id)
             return None
+        snapshot = detached_copy(user)
+        user_cache.set(user_id, snapshot)
+
+    # An older session than the user is stale, no query needed
+    if version is not None and snapshot.version != version:
+        return None
+    return remember(db.session.merge(snapshot, load=False))
+
+
+class KnownEmails:
+    '''
+    Bloom filter of registered emails, so login can reject unknown
+    addresses without a query
+      Attributes:
+        filter (BloomFilter):      emails known to this process
+        max_id (int):              highest user id in the filter
+
+    The filter is built on first use and rebuilt every
+    EMAIL_FILTER_REFRESH seconds. register, register_many and
+    update_email add to it directly. When an email is not found, the
+    users registered or whose email changed in other processes since the
+    last look are fetched, at most once every EMAIL_FILTER_CATCH_UP
+    seconds. Changes up to EMAIL_FILTER_OVERLAP seconds older than the
+    newest one seen are read again, which covers commits that lag their
+    timestamp and clocks of other hosts running behind.
+    '''
+
+    def __init__(self):
+        self.filter = None
+        self.max_id = 0
+        self.changed = None
+        self.built = 0
+        self.caught_up = 0
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        '''
+        Loads every registered email into a new filter
+        '''
+        rows = db.session.query(User.id, User.email,
+                                User.email_changed).all()
+        capacity = max(app.config.get('EMAIL_FILTER_CAPACITY', 100000),
+                       2 * len(rows))
+        bloom = BloomFilter(
+            capacity, app.config.get('EMAIL_FILTER_ERROR_RATE', 0.01))
+        bloom.update(row.email for row in rows)
+        with self._lock:
+            self.filter = bloom
+            self.max_id = max((row.id for row in rows), default=0)
+            self.changed = max((row.email_changed for row in rows
+                                if row.email_changed), default=None)
+            self.built = self.caught_up = time.monotonic()
+
+    def catch_up(self):
+        '''
+        Adds the users registered and the emails changed since the filter
+        was last updated
+        '''
+        since = User.id > self.max_id
+        if self.changed is not None:
+            since = or_(since, User.email_changed > self.changed - timedelta(
+                seconds=app.config.get('EMAIL_FILTER_OVERLAP', 60)))
+        rows = db.session.query(User.id, User.email,
+                                User.email_changed).filter(since).all()
+        with self._lock:
+            for row in rows:
+                self.filter.add(row.email)
+                self.max_id = max(self.max_id, row.id)
+                if row.email_changed and (self.changed is None or
+                                          row.email_changed > self.changed):
+                    self.changed = row.email_changed
+            self.caught_up = time.monotonic()
+
+    def add(self, email):
+        '''
+        Records a new or changed email
+        '''
+        with self._lock:
+            if self.filter is not None:
+                self.filter.add(email)
+
+    def might_exist(self, email):
+        '''
+        Checks if a user with this email may exist
+          Returns:
+            False only if no user has this email
+        '''
+        now = time.monotonic()
+        if self.filter is None or \
+           now - self.built > app.config.get('EMAIL_FILTER_REFRESH', 300):
+            self.rebuild()
+        if email in self.filter:
+            return True
+        if now - self.caught_up >= \
+           app.config.get('EMAIL_FILTER_CATCH_UP', 1):
+            self.catch_up()
+            return email in self.filter
+        return False
+
+    def stats(self):
+        '''
+        Returns the size of the filter for monitoring
+        '''
+        if self.filter is None:
+            return {'emails': 0, 'memory_bytes': 0}
+        return {'emails': len(self.filter),
+                'memory_bytes': self.filter.memory_bytes,
+                'error_rate': self.filter.error_rate}
+
+
+known_emails = KnownEmails()
+
+
+# Bloom filter of listing titles known to this process, it is loaded
+# from the database on first use
+listing_titles = None
+
+
+def known_listing_titles():
+    '''
+    Returns the Bloom filter of listing titles, loading it on first use
+    '''
+    global listing_titles
+    if listing_titles is None:
+        titles = BloomFilter(
+            app.config.get('TITLE_BLOOM_CAPACITY', 10000),
+            app.config.get('TITLE_BLOOM_ERROR_RATE', 0.01))
+        titles.update(title for (title,) in db.session.query(Listing.title))
+        listing_titles = titles
+    return listing_titles
 
-        # Satisfy R4-1
-        check = re.match("^(?! )[A-Za-z0-9 ]*(?<! )$", title)
 
-        if check is None:
+def title_exists(title, owner_id=None):
+    '''
+    Checks if a listing title is already taken
+      Parameters:
+        title (str):               listing title
+        owner_id (int):            only look at this owner's listings
+      Returns:
+        True if a listing with that title exists otherwise False
+    '''
+    # Most fresh titles are confirmed unique without a query
+    if title not in known_listing_titles():
+        return False
+
+    # Possible hit, confirm with an indexed EXISTS probe
+    if owner_id is None:
+        return db.session.scalar(TITLE_EXISTS, {'title': title})
+    return db.session.scalar(OWNER_TITLE_EXISTS,
+                             {'title': title, 'owner_id': owner_id})
+
+
+def check_listing_update(listing, title=None, description=None,
+                         price=None, postal_code=None):
+    '''
+    Checks a listing update against R4 and R5 without applying it
+      Attributes:
+        listing:                   Listing object or row with title,
+                                   price and owner_id
+        title (str):               listing title (optional)
+        description (str):         listing description (optional)
+        price (float):             listing price (optional)
+        postal_code (str):         listing postal code (optional)
+      Returns:
+        A dict of column values to write if valid otherwise None
+    '''
+    values = {}
+
+    # If all optional arguments are skipped
+    if title is None and description is None and price is None and \
+       postal_code is None:
+        return None
+
+    # If title was given
+    if title is not None:
+
+        # Satisfy R4-1 and R4-2
+        if not validation.valid_title(title):
             return None
 
         # Satisfy R4-8
-        existed = Listing.query.filter_by(title=title,
-                                          owner_id=listing.owner_id).all()
-        if len(existed) > 0 and listing.title != title:
+        if listing.title != title and \
+           title_exists(title, owner_id=listing.owner_id):
             return None
 
         # Update title
-        listing.title = title
+        values['title'] = title
 
     # If description was given
     if description is not None:
 
-        # If description is of instance str
-        if not isinstance(description, str):
-            return None
-
-        # Satisfy R4-3
-        if len(description) < 20 or len(description) > 2000:
+        # Satisfy R4-3 and R4-4 against the new or the current title
+        if not validation.valid_description(
+                description, title if title is not None else listing.title):
             return None
 
-        # If new title was given or not
-        if title is not None:
-
-            # Satisfy R4-4
-            if len(description) <= len(title):
-                return None
-        else:
-
-            # Satisfy R4-4
-            if len(description) <= len(listing.title):
-                return None
-
         # Update description
-        listing.description = description
+        values['description'] = description
 
     # If price was given
     if price is not None:
@@ -362,7 +1200,7 @@ def update_listing(listing, title=None, description=None, price=None):
             return None
 
         # Satisfy R4-5
-        if price < 10 or price > 10000:
+        if not validation.valid_price(price):
             return None
 
         # Satisfy R5-2
@@ -370,24 +1208,180 @@ def update_listing(listing, title=None, description=None, price=None):
             return None
 
         # Update price
-        listing.price = price
+        values['price'] = price
+
+    # If postal code was given, it also moves the listing's FSA
+    if postal_code is not None:
+        if not validation.valid_postal_code(postal_code):
+            return None
+        values['postal_code'] = postal_code
+        values['fsa'] = postal_code[:3]
 
     # Satisfy R4-6 and R5-3
     if date.today() > date(2021, 1, 2) and \
        date.today() < date(2025, 1, 2):
-        listing.last_modified_date = date.today()
+        values['last_modified_date'] = date.today()
     else:
         return None
 
-    # Commit updates
-    db.session.commit()
+    return values
+
+
+def update_listing(listing, title=None, description=None, price=None,
+                   postal_code=None):
+    '''
+    Updates a listing
+      Attributes:
+        listing (Listing)          Listing object
+        title (str):               listing title (optional)
+        description (str):         listing description (optional)
+        price (float):             listing price (optional)
+        postal_code (str):         listing postal code (optional)
+      Returns:
+        The listing object if succeeded otherwise None
+    '''
+
+    # If listing is not of instance Listing
+    if not isinstance(listing, Listing):
+        return None
+
+    # Validate everything before touching the listing
+    values = check_listing_update(listing, title=title,
+                                  description=description, price=price,
+                                  postal_code=postal_code)
+    if values is None:
+        return None
+
+    for column, value in values.items():
+        setattr(listing, column, value)
+
+    # Commit updates, the unique constraint on title has the final say
+    known_listing_titles().add(listing.title)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
 
     # Return listing
     return listing
 
 
+def update_listings(changes, owner_id=None):
+    '''
+    Updates many listings in one transaction
+      Attributes:
+        changes (list):            dicts with an 'id' key and optional
+                                   'title', 'description', 'price' and
+                                   'postal_code'
+        owner_id (int):            only allow listings of this owner
+                                   (optional)
+      Returns:
+        A dict mapping each listing id to True if its update was
+        applied otherwise False. An id given more than once fails and
+        none of its changes are applied. A change that is not a dict,
+        or whose id is not an integer, maps from the string form of the
+        change or id to False.
+    '''
+    outcomes = {}
+
+    def valid_id(listing_id):
+        return isinstance(listing_id, int) and \
+            not isinstance(listing_id, bool)
+
+    # Load the current state of every listing with one query
+    ids = [change.get('id') for change in changes
+           if isinstance(change, dict) and valid_id(change.get('id'))]
+    rows = db.session.query(
+        Listing.id, Listing.title, Listing.price, Listing.owner_id
+    ).filter(Listing.id.in_(ids)).all()
+    current = {row.id: row for row in rows}
+
+    accepted = {}
+    claimed = set()
+    # title claimed by each accepted listing
+    titles = {}
+    for change in changes:
+        # e.g. a number or a list from a JSON body
+        if not isinstance(change, dict):
+            outcomes[str(change)] = False
+            continue
+        listing_id = change.get('id')
+        # e.g. a list, an object or true from a JSON body
+        if not valid_id(listing_id):
+            outcomes[str(listing_id)] = False
+            continue
+        row = current.get(listing_id)
+
+        # A repeated id is ambiguous, drop the change accepted before
+        if listing_id in outcomes:
+            accepted.pop(listing_id, None)
+            claimed.discard(titles.pop(listing_id, None))
+            outcomes[listing_id] = False
+            continue
+
+        # Unknown listing or someone else's listing
+        if row is None or \
+           (owner_id is not None and row.owner_id != owner_id):
+            outcomes[listing_id] = False
+            continue
+
+        # Same R4/R5 rules as a single update
+        values = check_listing_update(row, title=change.get('title'),
+                                      description=change.get('description'),
+                                      price=change.get('price'),
+                                      postal_code=change.get('postal_code'))
+
+        # Titles are unique across owners and within the batch
+        title = values.get('title') if values else None
+        if title is not None and title != row.title and \
+           (title in claimed or title_exists(title)):
+            values = None
+
+        if values is None:
+            outcomes[listing_id] = False
+            continue
+
+        if title is not None:
+            claimed.add(title)
+            titles[listing_id] = title
+        accepted[listing_id] = values
+        outcomes[listing_id] = True
+
+    if not accepted:
+        return outcomes
+
+    # One UPDATE for the whole batch, each column picks its new value
+    # by listing id
+    columns = {}
+    for listing_id, values in accepted.items():
+        for column, value in values.items():
+            attribute = getattr(Listing, column)
+            columns.setdefault(column, {})[listing_id] = \
+                literal(value, attribute.type)
+    statement = update(Listing).where(
+        Listing.id.in_(list(accepted))
+    ).values({
+        column: case(mapping, value=Listing.id,
+                     else_=getattr(Listing, column))
+        for column, mapping in columns.items()
+    }).execution_options(synchronize_session=False)
+
+    known_listing_titles().update(claimed)
+    try:
+        db.session.execute(statement)
+        # committing also expires any loaded Listing objects
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {listing_id: False for listing_id in outcomes}
+
+    return outcomes
+
+
 def create_listing(title: str, description: str, price: float,
-                   last_modified_date: date, owner_id: int):
+                   last_modified_date: date, owner_id: int,
+                   postal_code: str = ''):
     '''
     Creates a listing
       Attributes:
@@ -396,36 +1390,24 @@ def create_listing(title: str, description: str, price: float,
         price (float):             listing price
         last_modified_date (date): last modified date of listing
         owner_id (int):            listing owner's id
+        postal_code (str):         listing postal code (optional)
       Returns:
         The listing object if succeeded otherwise None
     '''
-    # Satisfy R4-1
-    if title == '':
-        return None
-
-    if title[0] == ' ' or title[-1] == ' ':
-        return None
-
-    if not title.replace(' ', '').isalnum():
-        return None
-
-    # Satisfy R4-2
-    if len(title) > 80:
+    # Satisfy R4-1 and R4-2
+    if not validation.valid_title(title):
         return None
 
-    # Satisfy R4-3
-    if len(description) < 20 or len(description) > 2000:
+    # Satisfy R4-3 and R4-4
+    if not validation.valid_description(description, title):
         return None
 
-    # Satisfy R4-4
-    if len(description) <= len(title):
+    # Satisfy R4-5
+    if not validation.valid_price(price):
         return None
 
-    # Satisfy R4-5
-    if isinstance(price, float) or isinstance(price, int):
-        if price < 10 or price > 10000:
-            return None
-    else:
+    # The postal code is optional, but has to be Canadian when given
+    if postal_code and not validation.valid_postal_code(postal_code):
         return None
 
     # Satisfy R4-6
@@ -437,7 +1419,7 @@ def create_listing(title: str, description: str, price: float,
         return None
 
     # Satisfy R4-7
-    user = User.query.filter_by(id=owner_id).first()
+    user = get_user(owner_id)
     if user is None:
         return None
 
@@ -445,22 +1427,97 @@ def create_listing(title: str, description: str, price: float,
         return None
 
     # Satisfy R4-8
-    if len(Listing.query.filter_by(title=title).all()) > 0:
+    if title_exists(title):
         return None
 
     # create a new listing
     listing = Listing(title=title, description=description,
                       price=price, last_modified_date=last_modified_date,
-                      owner_id=owner_id)
+                      owner_id=owner_id, postal_code=postal_code or '',
+                      fsa=postal_code[:3] if postal_code else None)
 
     # add it to the current database session
     db.session.add(listing)
-    # actually save the user object
-    db.session.commit()
+    known_listing_titles().add(title)
+    # actually save the listing object, a concurrent insert of the same
+    # title is rejected by the unique constraint
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
 
     return listing
 
 
+# Neighbours of every FSA with adjacency rows, loaded on first use and
+# reloaded after FSA_ADJACENCY_TTL seconds, since the table is usually
+# loaded by the CLI in another process
+fsa_adjacency = LRUCache(1, app.config.get('FSA_ADJACENCY_TTL', 300))
+
+
+def fsa_neighbours(fsa):
+    '''
+    Returns the precomputed neighbours of a forward sortation area
+    '''
+    adjacency = fsa_adjacency.get('adjacency')
+    if adjacency is None:
+        adjacency = {}
+        for area, neighbour in db.session.query(FsaAdjacency.fsa,
+                                                FsaAdjacency.neighbour):
+            adjacency.setdefault(area, []).append(neighbour)
+        fsa_adjacency.set('adjacency', adjacency)
+    return adjacency.get(fsa, [])
+
+
+def load_fsa_adjacency(pairs):
+    '''
+    Replaces the FSA adjacency table
+      Attributes:
+        pairs (iterable):          (fsa, neighbour) tuples, stored in
+                                   both directions
+      Returns:
+        The number of rows stored
+    '''
+    rows = set()
+    for fsa, neighbour in pairs:
+        fsa, neighbour = fsa.strip().upper(), neighbour.strip().upper()
+        if fsa != neighbour:
+            rows.add((fsa, neighbour))
+            rows.add((neighbour, fsa))
+    FsaAdjacency.query.delete()
+    if rows:
+        db.session.execute(insert(FsaAdjacency),
+                           [{'fsa': fsa, 'neighbour': neighbour}
+                            for fsa, neighbour in sorted(rows)])
+    db.session.commit()
+    fsa_adjacency.clear()
+    return len(rows)
+
+
+def listings_near(user):
+    '''
+    Finds listings in the user's forward sortation area and its
+    neighbours, using the index on Listing.fsa
+      Attributes:
+        user (User):               user with a postal code
+      Returns:
+        A list of listings, those in the user's own FSA first
+    '''
+    if not user.postal_code:
+        return []
+    fsa = user.postal_code[:3]
+    neighbours = fsa_neighbours(fsa)
+    if neighbours:
+        area = Listing.fsa.in_([fsa] + neighbours)
+    else:
+        # without adjacency data, use the FSAs of the same district,
+        # i.e. the same first two characters, as an indexed range
+        area = Listing.fsa.between(fsa[:2] + 'A', fsa[:2] + 'Z')
+    listings = Listing.query.filter(area).order_by(Listing.id).all()
+    return sorted(listings, key=lambda listing: listing.fsa != fsa)
+
+
 def register(name, email, password):
     '''
     Register a new user
@@ -488,37 +1545,24 @@ def register(name, email, password):
     if ("@" not in email):
         return None
     # thorough check
-    email_val = re.compile(
-        r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(.[A-Z|a-z]{2,})+')
-    if not re.fullmatch(email_val, email):
+    if not validation.valid_email(email):
         return None
 
     # R1-4 Password has to meet the required complexity
     # check if password is at least 6 characters,
     # with upper, lower and special characters
-    if not (len(password) >= 6
-            and check_str_contains_lower(password)
-            and check_str_contains_upper(password)
-            and check_str_contains_special(password)):
-        return None
-
-    # R1-5 Username has to be non-empty
-    if name == '':
-        return None
-
-    # R1-5 Alpahnumerical, and space allowed only as not prefix/suffix
-    name_validation = re.compile('^(?! )[A-Za-z0-9 ]*(?<! )$')
-    if not re.fullmatch(name_validation, name):
+    if not validation.valid_password(password):
         return None
 
+    # R1-5 Username has to be non-empty, alpahnumerical, and space
+    # allowed only as not prefix/suffix
     # R1-6 Username has to be longer than 2 but shorter than 20
-    if len(name) < 3:
-        return None
-    elif len(name) > 19:
+    if not validation.valid_name(name):
         return None
 
     # R1-7 check if the email has been used:
-    existing_email = User.query.filter_by(email=email).all()
+    existing_email = db.session.scalars(USER_BY_EMAIL,
+                                        {'value': email}).all()
     if len(existing_email) > 0:
         return None
 
@@ -532,41 +1576,130 @@ def register(name, email, password):
     # Default is set to 100 in the User class
 
     # create a new user
-    user = User(username=name, email=email, password=password)
+    user = User(username=name, email=email,
+                password=hash_password(password))
 
     # add it to the current database session
     db.session.add(user)
     # actually save the user object
     db.session.commit()
+    known_emails.add(email)
 
     return user
 
 
+def register_many(records, chunk_size=500):
+    '''
+    Registers many users, e.g. when migrating an existing customer base
+      Parameters:
+        records (iterable):  dicts with name, email and password, read
+                             lazily one chunk at a time
+        chunk_size (int):    number of users validated and inserted
+                             together
+      Returns:
+        A tuple of the number of users created and a list of
+        (row number, reason) for every rejected row
+    '''
+    created = 0
+    rejected = []
+    chunk = []
+    for number, record in enumerate(records, start=1):
+        chunk.append((number, record))
+        if len(chunk) >= chunk_size:
+            created += _register_chunk(chunk, rejected)
+            chunk = []
+    if chunk:
+        created += _register_chunk(chunk, rejected)
+    return created, rejected
+
+
+def _register_chunk(chunk, rejected):
+    '''
+    Validates and inserts one chunk of register_many
+    '''
+    fields = ['name', 'email', 'password']
+    records = [{field: record.get(field) for field in fields}
+               for number, record in chunk]
+
+    # R1-1, R1-3, R1-4, R1-5 and R1-6
+    errors = validation.validate_many(records, fields)
+
+    # R1-7 one query for the emails of the whole chunk
+    emails = [record['email'] for record, invalid in zip(records, errors)
+              if not invalid]
+    taken = set()
+    if emails:
+        taken = {email for (email,) in db.session.query(User.email)
+                 .filter(User.email.in_(emails))}
+
+    accepted = []
+    for (number, _), record, invalid in zip(chunk, records, errors):
+        if invalid:
+            rejected.append((number, 'invalid ' + ', '.join(invalid)))
+        elif record['email'] in taken:
+            rejected.append((number, 'email already registered'))
+        else:
+            # also catches repeated emails within the chunk
+            taken.add(record['email'])
+            accepted.append((number, record))
+    if not accepted:
+        return 0
+
+    # R1-8, R1-9 and R1-10 come from the column defaults
+    hashes = hash_passwords([record['password']
+                             for number, record in accepted])
+    rows = [{'username': record['name'], 'email': record['email'],
+             'password': password}
+            for (number, record), password in zip(accepted, hashes)]
+    try:
+        db.session.execute(insert(User), rows)
+        db.session.commit()
+        for row in rows:
+            known_emails.add(row['email'])
+    except IntegrityError:
+        # another writer took one of the emails meanwhile, insert the
+        # chunk row by row to find out which
+        db.session.rollback()
+        return _register_rows(accepted, rows, rejected)
+    return len(rows)
+
+
+def _register_rows(accepted, rows, rejected):
+    '''
+    Inserts the rows of a chunk one at a time
+    '''
+    created = 0
+    for (number, record), row in zip(accepted, rows):
+        try:
+            db.session.execute(insert(User), [row])
+            db.session.commit()
+            known_emails.add(row['email'])
+            created += 1
+        except IntegrityError:
+            db.session.rollback()
+            rejected.append((number, 'email already registered'))
+    return created
+
+
 def check_str_contains_upper(str):
     '''
     Checks if str contains an upper case letter
     '''
-    for x in str:
-        if x == x.upper():
-            return True
-    return False
+    return bool(validation.password_classes(str) & validation.UPPER)
 
 
 def check_str_contains_lower(str):
     '''
     Checks if str contains a lower case letter
     '''
-    for x in str:
-        if x == x.lower():
-            return True
-    return False
+    return bool(validation.password_classes(str) & validation.LOWER)
 
 
 def check_str_contains_special(str):
     '''
     Checks if str contains punctuations
     '''
-    return any(special in str for special in string.punctuation)
+    return bool(validation.password_classes(str) & validation.SPECIAL)
 
 
 def login(email, password):
@@ -586,22 +1719,28 @@ def login(email, password):
     if not email or not password:
         return None
     # R1-3 The email has to follow addr-spec defined in RFC 5322
-    email_val = re.compile(
-        r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(.[A-Z|a-z]{2,})+')
-    if not re.fullmatch(email_val, email):
+    if not validation.valid_email(email):
         return None
 
     # R1-4 Password has to meet the required complexity
     # check if password is at least 6 characters,
     # with upper, lower and special characters
-    if not (len(password) >= 6
-            and check_str_contains_lower(password)
-            and check_str_contains_upper(password)
-            and check_str_contains_special(password)):
+    if not validation.valid_password(password):
         return None
 
-    valids = User.query.filter_by(email=email, password=password).all()
-    if len(valids) != 1:
+    # Unknown emails are rejected without a query
+    if not known_emails.might_exist(email):
         return None
 
-    return valids[0]
+    valids = db.session.scalars(USER_BY_EMAIL, {'value': email}).all()
+    if len(valids) != 1 or not verify_password(password, valids[0].password):
+        return None
+    user = valids[0]
+
+    # Upgrade plain or outdated hashes now that the password is known,
+    # this is not a credential change so sessions stay valid
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+
+    return user
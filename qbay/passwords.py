@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from qbay import app
+
+
+'''
+This file defines password hashing. Hashes are computed with
+PBKDF2-SHA256 on a bounded thread pool (hashlib releases the GIL while
+hashing), so a burst of logins cannot occupy more CPU than the pool
+allows.
+
+Stored format: pbkdf2_sha256$<iterations>$<salt>$<hash>
+'''
+
+
+ALGORITHM = 'pbkdf2_sha256'
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def hash_pool():
+    '''
+    Returns the thread pool used for hashing, created on first use
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=app.config.get('PASSWORD_WORKERS', 4),
+                thread_name_prefix='password-hash')
+    return _pool
+
+
+def current_iterations():
+    '''
+    Returns the configured work factor
+    '''
+    return app.config.get('PASSWORD_ITERATIONS', 260000)
+
+
+def _encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                               salt, iterations)
+
+
+def _hash(password, iterations):
+    salt = os.urandom(16)
+    digest = _pbkdf2(password, salt, iterations)
+    return '%s$%i$%s$%s' % (ALGORITHM, iterations,
+                            _encode(salt), _encode(digest))
+
+
+def _verify(password, stored):
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        # Accounts created before hashing store the plain password
+        return hmac.compare_digest(password.encode('utf-8'),
+                                   stored.encode('utf-8'))
+    try:
+        iterations = int(parts[1])
+        salt = base64.b64decode(parts[2])
+        expected = base64.b64decode(parts[3])
+    except ValueError:
+        return False
+    return hmac.compare_digest(_pbkdf2(password, salt, iterations),
+                               expected)
+
+
+def hash_password(password, iterations=None):
+    '''
+    Hashes a password on the hashing pool
+      Parameters:
+        password (string):   plain password
+        iterations (int):    work factor, defaults to the configured one
+      Returns:
+        The encoded hash
+    '''
+    if iterations is None:
+        iterations = current_iterations()
+    return hash_pool().submit(_hash, password, iterations).result()
+
+
+def hash_passwords(passwords, iterations=None):
+    '''
+    Hashes many passwords, spread over the hashing pool
+      Parameters:
+        passwords (list):    plain passwords
+        iterations (int):    work factor, defaults to the configured one
+      Returns:
+        The encoded hashes in the same order
+    '''
+    if iterations is None:
+        iterations = current_iterations()
+    return list(hash_pool().map(_hash, passwords,
+                                [iterations] * len(passwords)))
+
+
+def verify_password(password, stored):
+    '''
+    Checks a password against a stored hash on the hashing pool
+      Parameters:
+        password (string):   plain password
+        stored (string):     value of User.password
+      Returns:
+        True if the password matches otherwise False
+    '''
+    return hash_pool().submit(_verify, password, stored).result()
+
+
+def needs_rehash(stored):
+    '''
+    Checks if a stored hash is plain text or uses another work factor
+    '''
+    parts = stored.split('$')
+    return len(parts) != 4 or parts[0] != ALGORITHM or \
+        parts[1] != str(current_iterations())
@@ -0,0 +1,144 @@
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+'''
+This file defines the database connection pool settings, the tuned
+SQLite profile and the instrumentation behind the db_pool section of
+/metrics
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that measures how long a checkout waits for a connection
+      Attributes:
+        checkouts (int):           number of connections handed out
+        timeouts (int):            checkouts that gave up after the pool
+                                   timeout
+        wait_total (float):        seconds spent in checkouts
+        wait_max (float):          longest checkout in seconds
+    '''
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return connection
+
+
+def in_memory(uri):
+    '''
+    Checks if a database URI is an in-memory SQLite database, which
+    lives on a single connection and cannot be pooled
+    '''
+    return uri.startswith('sqlite') and \
+        (uri.endswith(':memory:') or uri.endswith('://'))
+
+
+def engine_options(config):
+    '''
+    Builds SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* settings
+      Parameters:
+        config (dict):       app configuration
+      Returns:
+        The keyword arguments of create_engine
+    '''
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+    if not in_memory(config['SQLALCHEMY_DATABASE_URI']):
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+        })
+    return options
+
+
+def sqlite_pragmas(config):
+    '''
+    Returns the (name, value) PRAGMAs of the tuned SQLite profile: WAL
+    so readers do not wait for writers, synchronous=NORMAL which is safe
+    with WAL, a page cache of SQLITE_CACHE_KB per connection, memory
+    mapped reads and a busy timeout instead of immediate lock errors
+    '''
+    return [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        # a negative cache_size is in KiB instead of pages
+        ('cache_size', -config['SQLITE_CACHE_KB']),
+        ('mmap_size', config['SQLITE_MMAP_SIZE']),
+        ('busy_timeout', config['SQLITE_BUSY_TIMEOUT']),
+    ]
+
+
+def tune_sqlite(engine, pragmas):
+    '''
+    Runs PRAGMAs on every new connection of a SQLite file engine
+      Parameters:
+        engine (Engine):     engine to tune, other databases are skipped
+        pragmas (list):      (name, value) pairs, see sqlite_pragmas
+      Returns:
+        True if the engine was tuned otherwise False
+    '''
+    if engine.dialect.name != 'sqlite' or \
+            in_memory(engine.url.render_as_string()):
+        return False
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    return True
+
+
+def pool_stats(pool):
+    '''
+    Returns the occupancy and checkout latency of a pool for monitoring
+    '''
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'in_use': pool.checkedout(),
+            'idle': pool.checkedin(),
+            # overflow() counts up from -size to max_overflow
+            'overflow': max(0, pool.overflow()),
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            checkouts = pool.checkouts
+            stats.update({
+                'checkouts': checkouts,
+                'timeouts': pool.timeouts,
+                'wait_avg_ms': round(
+                    1000 * pool.wait_total / checkouts, 3)
+                if checkouts else 0.0,
+                'wait_max_ms': round(1000 * pool.wait_max, 3),
+            })
+    return stats
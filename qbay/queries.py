@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from flask import current_app, g, has_app_context, has_request_context, \
+    request
+from sqlalchemy import event
+from qbay.passwords import ALGORITHM
+
+
+'''
+This file defines the per-request SQL statement counter and the slow
+query log. It counts the statements and database time of every request,
+warns when a request goes over its budget or repeats the same statement
+(a likely N+1 query) and, in debug mode, reports the counts in response
+headers. Statements slower than SLOW_QUERY_MS are written with their
+query plan to the rotating SLOW_QUERY_LOG file.
+'''
+
+
+# modules skipped when looking for the code that ran a statement
+LIBRARIES = ('sqlalchemy', 'flask_sqlalchemy', 'qbay.queries')
+# statements whose plan is captured, EXPLAIN does not run them
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE')
+
+slow_log = logging.getLogger('qbay.slow_queries')
+slow_log.setLevel(logging.INFO)
+slow_log.propagate = False
+_slow_log_lock = threading.Lock()
+
+
+def before_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    # kept on the statement's own context, a statement that raises
+    # never reaches after_execute and leaves nothing behind
+    context._query_start = time.perf_counter()
+
+
+def after_execute(conn, cursor, statement, parameters, context,
+                  executemany):
+    elapsed = time.perf_counter() - context._query_start
+    if has_request_context() and 'query_stats' in g:
+        stats = g.query_stats
+        stats['count'] += 1
+        stats['time'] += elapsed
+        # parameters are bound separately, so the text is the shape
+        stats['shapes'][statement] += 1
+    if has_app_context() and current_app.config.get('SLOW_QUERY_LOG'):
+        threshold = current_app.config.get('SLOW_QUERY_MS', 100)
+        if elapsed * 1000 >= threshold:
+            log_slow_query(conn, statement, parameters, executemany,
+                           elapsed)
+
+
+def caller():
+    '''
+    Returns module.function of the code that ran the current statement
+    '''
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if not module.startswith(LIBRARIES):
+            return '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def explain(conn, statement, parameters):
+    '''
+    Returns the query plan of a statement as a list of rows
+    '''
+    if conn.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    # a separate DBAPI cursor, so the statement's own results and the
+    # statement events are left alone
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [list(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def redact(parameters):
+    '''
+    Hides password hashes among the parameters of a statement, also in
+    the list of parameter sets of an executemany
+    '''
+    if isinstance(parameters, str) and parameters.startswith(ALGORITHM + '$'):
+        return '<password hash>'
+    if isinstance(parameters, dict):
+        return {name: redact(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) for value in parameters]
+    return parameters
+
+
+def slow_log_file(config):
+    '''
+    Points the slow query log at SLOW_QUERY_LOG, opening it on first use
+    '''
+    path = os.path.abspath(config['SLOW_QUERY_LOG'])
+    with _slow_log_lock:
+        files = [handler for handler in slow_log.handlers
+                 if isinstance(handler, RotatingFileHandler)]
+        if any(handler.baseFilename == path for handler in files):
+            return
+        for handler in files:
+            slow_log.removeHandler(handler)
+            handler.close()
+        handler = RotatingFileHandler(
+            path, maxBytes=config.get('SLOW_QUERY_LOG_BYTES', 1048576),
+            backupCount=config.get('SLOW_QUERY_LOG_BACKUPS', 5),
+            delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        slow_log.addHandler(handler)
+
+
+def log_slow_query(conn, statement, parameters, executemany, elapsed):
+    '''
+    Writes a slow statement, where it came from and its plan to the slow
+    query log, one JSON object per line
+    '''
+    entry = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'ms': round(elapsed * 1000, 3),
+        'statement': ' '.join(statement.split()),
+        'parameters': redact(parameters),
+        'route': '%s %s' % (request.method, request.path)
+        if has_request_context() else None,
+        'function': caller(),
+        'plan': None,
+    }
+    if not executemany and \
+            statement.lstrip().upper().startswith(EXPLAINED):
+        try:
+            entry['plan'] = explain(conn, statement, parameters)
+        except Exception as error:
+            entry['plan'] = 'EXPLAIN failed: %s' % error
+    slow_log_file(current_app.config)
+    slow_log.info(json.dumps(entry, default=str))
+
+
+def request_queries():
+    '''
+    Returns the statement count, database seconds and statement shapes
+    of the current request
+    '''
+    return g.get('query_stats') or \
+        {'count': 0, 'time': 0.0, 'shapes': Counter()}
+
+
+def count_queries(app, engines):
+    '''
+    Counts the statements run on engines during the requests of app,
+    and logs the slow ones when SLOW_QUERY_LOG is set
+      Parameters:
+        app (Flask):         app whose requests are counted
+        engines (iterable):  engines to listen to
+    '''
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        event.listen(engine, 'after_cursor_execute', after_execute)
+
+    @app.before_request
+    def start_counting():
+        g.query_stats = {'count': 0, 'time': 0.0, 'shapes': Counter()}
+
+    @app.after_request
+    def check_queries(response):
+        stats = request_queries()
+        route = '%s %s' % (request.method, request.path)
+        budget = app.config.get('QUERY_BUDGET', 20)
+        if stats['count'] > budget:
+            app.logger.warning('%s ran %i SQL statements, over its budget '
+                               'of %i', route, stats['count'], budget)
+        repeats = app.config.get('QUERY_REPEAT_LIMIT', 5)
+        for statement, times in stats['shapes'].items():
+            if times >= repeats:
+                app.logger.warning('%s ran the same statement %i times, '
+                                   'possible N+1 query: %s', route, times,
+                                   ' '.join(statement.split()))
+        if app.debug:
+            response.headers['X-Query-Count'] = str(stats['count'])
+            response.headers['X-Query-Time-Ms'] = \
+                '%.2f' % (stats['time'] * 1000)
+        return response
+
+    @app.teardown_request
+    def stop_counting(error=None):
+        g.pop('query_stats', None)
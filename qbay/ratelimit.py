@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+This file defines the in-memory rate limiter used to slow down
+credential stuffing against /login
+'''
+
+
+class RateLimiter:
+    '''
+    Token bucket rate limiter keyed by an arbitrary string
+      Attributes:
+        attempts (int):            attempts allowed in a burst
+        window (float):            seconds to earn back all attempts
+        maxsize (int):             maximum number of keys tracked, the
+                                   least recently used key is dropped
+        allowed (int):             number of allowed attempts
+        rejected (int):            number of rejected attempts
+        evicted (int):             number of keys dropped to stay small
+
+    Each key only costs a (tokens, timestamp) tuple.
+    '''
+
+    def __init__(self, attempts: int = 5, window: float = 60,
+                 maxsize: int = 10000):
+        self.attempts = attempts
+        self.window = window
+        self.maxsize = max(1, maxsize)
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        '''
+        Takes one attempt from the bucket of key
+          Returns:
+            True if the attempt is allowed otherwise False
+        '''
+        now = time.monotonic()
+        rate = self.attempts / self.window
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.attempts, now))
+            tokens = min(self.attempts, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+                self.rejected += 1
+                return False
+            self._buckets[key] = (tokens - 1, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+            self.allowed += 1
+            return True
+
+    def reset(self, key):
+        '''
+        Forgets the attempts of key
+        '''
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def stats(self):
+        '''
+        Returns the counters of the limiter for monitoring
+        '''
+        return {'allowed': self.allowed, 'rejected': self.rejected,
+                'evicted': self.evicted, 'tracked': len(self._buckets)}
@@ -0,0 +1,69 @@
+from flask import g, request
+from flask_sqlalchemy.session import Session
+
+
+'''
+This file defines read replica routing. Queries of GET requests go to
+the 'replica' bind, everything else goes to the primary database. A
+client that just sent a POST reads from the primary for a few seconds,
+so it sees its own writes even if the replica lags behind.
+'''
+
+
+REPLICA = 'replica'
+# cookie telling the next requests of a client to read from the primary
+STICKY_COOKIE = 'qbay_primary'
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(Session):
+    '''
+    Session sending the reads of read-only requests to the replica
+    '''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and g.get('db_read_replica'):
+            if self._flushing or getattr(clause, 'is_dml', False):
+                # a request that writes reads its own writes afterwards
+                g.db_read_replica = False
+            else:
+                engine = self._db.engines.get(REPLICA)
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def has_replica(app):
+    '''
+    Checks if a replica database is configured
+    '''
+    return REPLICA in app.config.get('SQLALCHEMY_BINDS', {})
+
+
+def route_reads(app):
+    '''
+    Registers the request hooks choosing between replica and primary
+      Parameters:
+        app (Flask):         app whose SQLALCHEMY_BINDS may have a
+                             'replica' database
+    '''
+
+    @app.before_request
+    def choose_database():
+        g.db_read_replica = has_replica(app) and \
+            request.method in READ_METHODS and \
+            STICKY_COOKIE not in request.cookies
+
+    @app.after_request
+    def stick_to_primary(response):
+        if has_replica(app) and request.method not in READ_METHODS:
+            response.set_cookie(
+                STICKY_COOKIE, '1', httponly=True,
+                max_age=app.config.get('REPLICA_STICKY_SECONDS', 5))
+        return response
+
+    @app.teardown_request
+    def forget_database(error=None):
+        # code running outside of requests, e.g. the CLI, uses the primary
+        g.pop('db_read_replica', None)
@@ -0,0 +1,208 @@
+import secrets
+import sqlite3
+import threading
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from qbay.cache import LRUCache
+
+
+'''
+This file defines server-side sessions. The browser only holds an opaque
+session id, the session data lives in a store with an in-memory LRU in
+front of it, so a session can be revoked centrally.
+'''
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    '''
+    Session data loaded from a session store
+      Attributes:
+        sid (str):                 opaque session id
+        new (bool):                the session was created by this request
+        modified (bool):           the data changed during this request
+        logged_in:                 'logged_in' as loaded, a different
+                                   value when saving rotates the sid
+    '''
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.logged_in = self.get('logged_in')
+
+
+class SQLiteSessionStore:
+    '''
+    Session store backed by a table in a SQLite file
+      Attributes:
+        path (str):                path of the SQLite file
+        purge_every (int):         saves between purges of expired rows
+    '''
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._saves = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        '''
+        Returns the connection of the current thread, the file and its
+        table are created on first use
+        '''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS session ('
+                ' sid TEXT PRIMARY KEY,'
+                ' user_id INTEGER,'
+                ' data TEXT NOT NULL,'
+                ' expires REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_session_user_id '
+                'ON session (user_id)')
+            self._local.connection = connection
+        return connection
+
+    def load(self, sid):
+        '''
+        Returns (data, expires) of a session otherwise None
+        '''
+        row = self._connection().execute(
+            'SELECT data, expires FROM session WHERE sid = ?',
+            (sid,)).fetchone()
+        return row
+
+    def save(self, sid, user_id, data, expires):
+        '''
+        Creates or replaces a session
+        '''
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO session (sid, user_id, data, expires) '
+            'VALUES (?, ?, ?, ?)', (sid, user_id, data, expires))
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            connection.execute('DELETE FROM session WHERE expires < ?',
+                               (time.time(),))
+
+    def delete(self, sid):
+        '''
+        Deletes one session
+        '''
+        self._connection().execute('DELETE FROM session WHERE sid = ?',
+                                   (sid,))
+
+    def delete_user(self, user_id):
+        '''
+        Deletes every session of a user
+          Returns:
+            The ids of the deleted sessions
+        '''
+        connection = self._connection()
+        sids = [sid for (sid,) in connection.execute(
+            'SELECT sid FROM session WHERE user_id = ?', (user_id,))]
+        connection.execute('DELETE FROM session WHERE user_id = ?',
+                           (user_id,))
+        return sids
+
+
+class ServerSideSessionInterface(SessionInterface):
+    '''
+    Flask session interface keeping sessions in a store
+      Attributes:
+        store:                     SQLiteSessionStore or another object
+                                   with the same methods
+        cache (LRUCache):          recently used sessions, its TTL bounds
+                                   how long another process may still
+                                   accept a revoked session
+    '''
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, cache_size=10000, cache_ttl=30):
+        self.store = store
+        self.cache = LRUCache(cache_size, cache_ttl)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            entry = self.cache.get(sid)
+            if entry is None:
+                row = self.store.load(sid)
+                if row is not None:
+                    entry = (self.serializer.loads(row[0]), row[1])
+                    self.cache.set(sid, entry)
+            if entry is not None and entry[1] > time.time():
+                return ServerSideSession(dict(entry[0]), sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # An emptied session, e.g. after logout, is removed everywhere
+        if not session:
+            if session.modified and not session.new:
+                self.revoke(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # A login or a switch of user gets a fresh id, so an id planted
+        # in the browser before the login (session fixation) is useless
+        if not session.new and session.get('logged_in') != session.logged_in:
+            self.revoke(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+            session.logged_in = session.get('logged_in')
+
+        if session.modified or session.new:
+            expires = time.time() + \
+                app.permanent_session_lifetime.total_seconds()
+            data = dict(session)
+            self.store.save(session.sid, self.user_id(data),
+                            self.serializer.dumps(data), expires)
+            self.cache.set(session.sid, (data, expires))
+
+        if self.should_set_cookie(app, session):
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+                domain=domain, path=path)
+
+    @staticmethod
+    def user_id(data):
+        '''
+        Returns the user id of a logged in session otherwise None
+        '''
+        logged_in = data.get('logged_in')
+        if isinstance(logged_in, (list, tuple)) and logged_in:
+            return logged_in[0]
+        return None
+
+    def revoke(self, sid):
+        '''
+        Ends one session
+        '''
+        self.store.delete(sid)
+        self.cache.pop(sid)
+
+    def revoke_user(self, user_id):
+        '''
+        Ends every session of a user
+          Returns:
+            The number of sessions ended
+        '''
+        sids = self.store.delete_user(user_id)
+        for sid in sids:
+            self.cache.pop(sid)
+        return len(sids)
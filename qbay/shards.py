@@ -0,0 +1,191 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, Date, Index, Integer, MetaData, Table, \
+    and_, bindparam, exists, func, or_, select
+
+
+'''
+This file defines the booking shards. With BOOKING_SHARDS above 1 the
+bookings are kept in that many SQLite databases instead of the booking
+table of the main database. All bookings of a listing live in the shard
+chosen by its id, so booking a listing or checking its availability
+locks and reads a single file, while the bookings of a user are read
+from every shard in parallel.
+
+Booking ids stay unique across shards and above the ids of the main
+database: with base, the largest booking id of the main database when
+the shards were created, shard i of n hands out base + i + 1,
+base + i + 1 + n, base + i + 1 + 2n, ...
+
+Bookings made before the switch are moved into the shards by
+'python -m qbay.cli shard-bookings', they keep their ids.
+'''
+
+
+# bind key of a shard in SQLALCHEMY_BINDS
+SHARD_BIND = 'booking_{}'
+
+# The booking table of a shard. Users and listings live in the main
+# database, so it has no foreign keys.
+metadata = MetaData()
+booking = Table(
+    'booking', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('user_id', Integer, nullable=False, index=True),
+    Column('listing_id', Integer, nullable=False),
+    Column('booking_date', Date),
+    Column('start_date', Date, nullable=False),
+    Column('end_date', Date, nullable=False),
+    Index('ix_booking_listing_dates',
+          'listing_id', 'start_date', 'end_date'))
+# one row holding the id base of the shard
+shard_meta = Table(
+    'shard_meta', metadata,
+    Column('id_base', Integer, nullable=False))
+
+# stays of a listing containing the start or the end date of a new stay,
+# as in qbay.models.BOOKING_OVERLAP
+OVERLAP = select(booking.c.id).where(
+    booking.c.listing_id == bindparam('listing_id'),
+    booking.c.start_date <= bindparam('end_date'),
+    or_(and_(booking.c.start_date <= bindparam('start_date'),
+             booking.c.end_date >= bindparam('start_date')),
+        and_(booking.c.start_date <= bindparam('end_date'),
+             booking.c.end_date >= bindparam('end_date'))))
+# The next id of the shard, the overlap check and the insert in one
+# statement, so concurrent bookings of a listing cannot both get in
+ID_BASE = select(
+    func.coalesce(func.max(shard_meta.c.id_base), 0)).scalar_subquery()
+NEXT_ID = select(
+    func.coalesce(func.max(booking.c.id),
+                  ID_BASE + bindparam('shard', type_=Integer) + 1
+                  - bindparam('shards', type_=Integer))
+    + bindparam('shards', type_=Integer)
+).where(booking.c.id > ID_BASE).scalar_subquery()
+INSERT_BOOKING = booking.insert().from_select(
+    ['id', 'user_id', 'listing_id', 'booking_date', 'start_date',
+     'end_date'],
+    select(NEXT_ID,
+           bindparam('user_id', type_=Integer),
+           bindparam('listing_id', type_=Integer),
+           bindparam('booking_date', type_=Date),
+           bindparam('start_date', type_=Date),
+           bindparam('end_date', type_=Date)).where(~exists(OVERLAP)))
+USER_BOOKINGS = select(booking).where(
+    booking.c.user_id == bindparam('user_id')).order_by(booking.c.id)
+# number of bookings and end of the last stay of every listing
+BOOKING_TOTALS = select(
+    booking.c.listing_id, func.count(booking.c.id),
+    func.max(booking.c.end_date)).group_by(booking.c.listing_id)
+
+# fan out thread pools by number of shards, never shut down since
+# other requests may be using them
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def shard_binds(config):
+    '''
+    Returns the SQLALCHEMY_BINDS entries of the shards, none unless
+    BOOKING_SHARDS is above 1
+    '''
+    count = config.get('BOOKING_SHARDS', 0)
+    if count < 2:
+        return {}
+    return {SHARD_BIND.format(shard):
+            config['BOOKING_SHARD_STRING'].format(shard)
+            for shard in range(count)}
+
+
+def shard_engines(engines, count):
+    '''
+    Returns the engines of the shards in shard order
+      Parameters:
+        engines (dict):      engines by bind key, e.g. db.engines
+        count (int):         BOOKING_SHARDS
+      Returns:
+        A list of engines, empty when bookings are not sharded
+    '''
+    if count < 2:
+        return []
+    return [engines[SHARD_BIND.format(shard)] for shard in range(count)]
+
+
+def shard_index(listing_id, count):
+    '''
+    Returns the shard keeping the bookings of a listing. Listing ids are
+    handed out in sequence, so they spread evenly over the shards.
+    '''
+    return listing_id % count
+
+
+def create_shards(engines, base):
+    '''
+    Creates the tables of every shard that misses them
+      Parameters:
+        engines (list):      engines of the shards
+        base (int):          largest booking id of the main database,
+                             kept by shards that have no id base yet
+    '''
+    for engine in engines:
+        metadata.create_all(engine)
+        with engine.begin() as connection:
+            if connection.scalar(select(func.count()).select_from(
+                    shard_meta)) == 0:
+                connection.execute(shard_meta.insert().values(id_base=base))
+
+
+def id_base(engine):
+    '''
+    Returns the id base of a shard
+    '''
+    with engine.connect() as connection:
+        return connection.scalar(select(ID_BASE))
+
+
+def insert_booking(connection, shard, count, values):
+    '''
+    Inserts a booking into a shard unless the listing is booked during
+    the stay, in the transaction of connection
+      Parameters:
+        connection (Connection): connection to the shard
+        shard (int):             index of the shard
+        count (int):             number of shards
+        values (dict):           user_id, listing_id, booking_date,
+                                 start_date and end_date
+      Returns:
+        The id of the booking if it was inserted otherwise None
+    '''
+    result = connection.execute(INSERT_BOOKING,
+                                dict(values, shard=shard, shards=count))
+    if result.rowcount != 1:
+        return None
+    return result.lastrowid
+
+
+def fan_out_pool(size):
+    '''
+    Returns the thread pool querying size shards, created on first use.
+    BOOKING_SHARDS is fixed, so a process normally has one.
+    '''
+    with _pool_lock:
+        if size not in _pools:
+            _pools[size] = ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix='booking-shard')
+        return _pools[size]
+
+
+def fan_out(engines, statement, parameters=None):
+    '''
+    Runs a read-only statement on every shard in parallel
+      Parameters:
+        engines (list):      engines of the shards
+        statement:           statement against the shard booking table
+        parameters (dict):   values of its bind parameters
+      Returns:
+        A list with the rows of every shard, in shard order
+    '''
+    def run(engine):
+        with engine.connect() as connection:
+            return connection.execute(statement, parameters or {}).all()
+    return list(fan_out_pool(len(engines)).map(run, engines))
@@ -0,0 +1,210 @@
+import re
+import string
+
+
+'''
+This file defines input validators shared by the models
+'''
+
+
+# The R1-3 email rule used to be the regular expression
+#   ([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(.[A-Z|a-z]{2,})+
+# which backtracks exponentially on inputs such as '0' * 40, because
+# [.-_] is the range '.' to '_' and overlaps with [A-Za-z0-9].
+# valid_email_syntax accepts exactly the same strings by running the
+# equivalent automaton over the input once.
+
+ALNUM = frozenset(string.ascii_letters + string.digits)
+# [.-_]: every character from '.' (0x2E) to '_' (0x5F)
+SEPARATORS = frozenset(chr(c) for c in range(ord('.'), ord('_') + 1))
+DOMAIN = ALNUM | {'-'}
+# [A-Z|a-z]
+TLD = frozenset(string.ascii_letters + '|')
+
+# Automaton states, one bit each
+_START = 1       # nothing read yet
+_LOCAL = 2       # inside an [A-Za-z0-9]+ run of the local part
+_SEP = 4         # just read a [.-_] separator
+_AT = 8          # just read the '@'
+_DOMAIN = 16     # inside [A-Za-z0-9-]+
+_DOT = 32        # just read the '.' (any character) of a suffix
+_TLD1 = 64       # one [A-Z|a-z] of a suffix
+_TLD2 = 128      # two or more [A-Z|a-z] of a suffix, accepting
+
+
+def valid_email_syntax(email):
+    '''
+    Checks an email against the R1-3 pattern in linear time
+      Parameters:
+        email (string):    email address
+      Returns:
+        True if the whole string matches otherwise False
+    '''
+    states = _START
+    for char in email:
+        following = 0
+        if char in ALNUM and states & (_START | _LOCAL | _SEP):
+            following |= _LOCAL
+        if char in SEPARATORS and states & _LOCAL:
+            following |= _SEP
+        if char == '@' and states & _LOCAL:
+            following |= _AT
+        if char in DOMAIN and states & (_AT | _DOMAIN):
+            following |= _DOMAIN
+        # '.' in the pattern matches anything but a newline
+        if char != '\n' and states & (_DOMAIN | _TLD2):
+            following |= _DOT
+        if char in TLD:
+            if states & _DOT:
+                following |= _TLD1
+            if states & (_TLD1 | _TLD2):
+                following |= _TLD2
+        if not following:
+            return False
+        states = following
+    return bool(states & _TLD2)
+
+
+# Precompiled patterns, compiled once at import
+NAME_PATTERN = re.compile('(?! )[A-Za-z0-9 ]*(?<! )')
+POSTAL_CODE_PATTERN = re.compile('[A-Z][0-9][A-Z] [0-9][A-Z][0-9]')
+PUNCTUATION = frozenset(string.punctuation)
+ASCII_LOWER = frozenset(string.ascii_lowercase)
+ASCII_UPPER = frozenset(string.ascii_uppercase)
+
+# Password character classes found by valid_password
+UPPER = 1
+LOWER = 2
+SPECIAL = 4
+ALL_CLASSES = UPPER | LOWER | SPECIAL
+
+
+def valid_email(email):
+    '''
+    Checks an email against R1-1 and R1-3
+    '''
+    # R1-1 check if the email is empty
+    if not email or not isinstance(email, str):
+        return False
+    # R1-3 The email has to follow addr-spec defined in RFC 5322
+    return valid_email_syntax(email)
+
+
+def password_classes(password):
+    '''
+    Classifies the characters of a password in a single pass
+      Returns:
+        A bit set of UPPER, LOWER and SPECIAL
+    '''
+    # Same rules as the check_str_contains_* helpers: a character that
+    # upper() (lower()) leaves unchanged counts as upper (lower) case
+    chars = set(password)
+    classes = 0
+    if password.isascii():
+        # only a-z change under upper(), only A-Z under lower()
+        if not chars <= ASCII_LOWER:
+            classes |= UPPER
+        if not chars <= ASCII_UPPER:
+            classes |= LOWER
+    else:
+        for char in chars:
+            if char == char.upper():
+                classes |= UPPER
+            if char == char.lower():
+                classes |= LOWER
+    if not PUNCTUATION.isdisjoint(chars):
+        classes |= SPECIAL
+    return classes
+
+
+def valid_password(password):
+    '''
+    Checks a password against R1-1 and R1-4: at least 6 characters,
+    with upper, lower and special characters
+    '''
+    if not isinstance(password, str) or len(password) < 6:
+        return False
+    return password_classes(password) == ALL_CLASSES
+
+
+def valid_name(name):
+    '''
+    Checks a user name against R1-5 and R1-6
+    '''
+    # R1-6 Username has to be longer than 2 but shorter than 20
+    if not isinstance(name, str) or not 2 < len(name) < 20:
+        return False
+    # R1-5 Alpahnumerical, and space allowed only as not prefix/suffix
+    return NAME_PATTERN.fullmatch(name) is not None
+
+
+def valid_postal_code(postal_code):
+    '''
+    Checks a postal code against R3-2 and R3-3
+    '''
+    if not isinstance(postal_code, str):
+        return False
+    return POSTAL_CODE_PATTERN.fullmatch(postal_code) is not None
+
+
+def valid_title(title):
+    '''
+    Checks a listing title against R4-1 and R4-2
+    '''
+    # R4-1 non-empty, alphanumeric, space allowed only as not
+    # prefix/suffix and R4-2 at most 80 characters
+    if not isinstance(title, str) or not 0 < len(title) <= 80:
+        return False
+    return NAME_PATTERN.fullmatch(title) is not None
+
+
+def valid_description(description, title=''):
+    '''
+    Checks a listing description against R4-3 and R4-4
+    '''
+    if not isinstance(description, str):
+        return False
+    # R4-3 between 20 and 2000 characters
+    if not 20 <= len(description) <= 2000:
+        return False
+    # R4-4 longer than the title
+    return len(description) > len(title)
+
+
+def valid_price(price):
+    '''
+    Checks a listing price against R4-5
+    '''
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        return False
+    return 10 <= price <= 10000
+
+
+# Validator of every field name understood by validate_many
+VALIDATORS = {
+    'name': valid_name,
+    'email': valid_email,
+    'password': valid_password,
+    'postal_code': valid_postal_code,
+    'title': valid_title,
+    'price': valid_price,
+}
+
+
+def validate_many(records, fields=None):
+    '''
+    Validates many records with the shared rules, e.g. for bulk imports
+      Parameters:
+        records (iterable):   dicts mapping field names to values
+        fields (list):        fields to check, defaults to every field
+                              of a record that has a validator
+      Returns:
+        A list with, for each record, the names of its invalid fields
+    '''
+    results = []
+    for record in records:
+        checked = fields if fields is not None else \
+            [field for field in record if field in VALIDATORS]
+        results.append([field for field in checked
+                        if not VALIDATORS[field](record.get(field))])
+    return results
@@ -19,9 +19,18 @@ def pytest_sessionstart():
     '''
     print('Setting up environment..')
     db_file = 'db.sqlite'
-    if os.path.exists(db_file):
-        os.remove(db_file)
+    # with sqlite_profile=tuned the WAL files are left next to it
+    for path in (db_file, db_file + '-wal', db_file + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    # a cheap work factor keeps the many registrations in tests fast
+    app.config['PASSWORD_ITERATIONS'] = 1000
+    # every frontend test logs in from 127.0.0.1
+    app.config['LOGIN_RATE_LIMIT'] = False
     app.app_context().push()
+    # the schema is created once, like a deploy does
+    from qbay.models import init_schema
+    init_schema()
 
 
 def pytest_sessionfinish():
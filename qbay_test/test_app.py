@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+'''
+This file tests loading the app
+'''
+
+
+def run_child(code, **env):
+    """
+    Runs code in a fresh interpreter with extra environment variables
+    """
+    return subprocess.run([sys.executable, '-c', code],
+                          env=dict(os.environ, **env),
+                          capture_output=True, text=True)
+
+
+def test_import_touches_no_database():
+    """
+    Testing importing qbay opens neither the database nor the session
+    store, which here live in a directory that does not exist
+    """
+    missing = os.path.join(tempfile.mkdtemp(), 'missing')
+    result = run_child(
+        'from qbay import load_app\n'
+        'import qbay.models\n'
+        'load_app()\n',
+        db_string='sqlite:///' + os.path.join(missing, 'db.sqlite'),
+        session_db=os.path.join(missing, 'sessions.sqlite'))
+    assert result.returncode == 0, result.stderr
+    assert not os.path.exists(missing)
+
+
+def test_load_app_is_the_app():
+    """
+    Testing load_app returns the one module-level app
+    """
+    import qbay
+    assert qbay.load_app() is qbay.load_app() is qbay.app
+
+
+def test_lazy_schema():
+    """
+    Testing the tables are created by the first request, or only by
+    init-db when the schema is created at deploy time
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'db.sqlite')
+    first_request = (
+        'from qbay import load_app\n'
+        'print(load_app().test_client().get("/login").status_code)\n')
+    env = {'db_string': 'sqlite:///' + path,
+           'session_db': os.path.join(directory, 'sessions.sqlite')}
+
+    result = run_child(first_request, schema_init='deploy', **env)
+    assert result.returncode == 0, result.stderr
+    assert not os.path.exists(path)
+
+    result = run_child(first_request, schema_init='lazy', **env)
+    assert result.stdout.strip() == '200', result.stderr
+    assert os.path.exists(path)
+
+    result = run_child('from qbay.cli import main\nmain(["init-db"])\n',
+                       **env)
+    assert 'schema ready' in result.stdout, result.stderr
@@ -0,0 +1,136 @@
+import os
+import tempfile
+
+from sqlalchemy import create_engine, inspect
+
+from qbay import migrations
+from qbay.models import db
+
+'''
+This file tests the versioned schema migrations
+'''
+
+# The schema db.create_all() made before any migration existed
+BASELINE = [
+    'CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(80) '
+    'NOT NULL, email VARCHAR(120) NOT NULL UNIQUE, password VARCHAR(120) '
+    'NOT NULL, ship_addr VARCHAR(120) NOT NULL, postal_code VARCHAR(120) '
+    'NOT NULL, balance FLOAT NOT NULL)',
+    'CREATE TABLE listing (id INTEGER PRIMARY KEY, title VARCHAR(80) '
+    'NOT NULL UNIQUE, description VARCHAR(2000) NOT NULL, price FLOAT '
+    'NOT NULL, last_modified_date DATE, owner_id INTEGER NOT NULL '
+    'REFERENCES user (id))',
+    'CREATE TABLE review (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL '
+    'REFERENCES user (id), listing_id INTEGER NOT NULL REFERENCES '
+    'listing (id), review_text VARCHAR(2000) NOT NULL, date DATE)',
+    'CREATE TABLE booking (id INTEGER PRIMARY KEY, user_id INTEGER NOT '
+    'NULL REFERENCES user (id), listing_id INTEGER NOT NULL REFERENCES '
+    'listing (id), booking_date DATE, start_date DATE NOT NULL, end_date '
+    'DATE NOT NULL)',
+    "INSERT INTO user VALUES (1, 'old user', 'old@test.com', 'Abc#123', "
+    "'', '', 100)",
+]
+
+
+def baseline_engine():
+    """
+    Creates a database with the schema from before the migrations
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'baseline.sqlite')
+    engine = create_engine('sqlite:///' + path)
+    with engine.begin() as connection:
+        for statement in BASELINE:
+            connection.exec_driver_sql(statement)
+    return engine
+
+
+def schema(engine):
+    """
+    Returns the columns and indexes of every table of a database
+    """
+    inspector = inspect(engine)
+    return {table: (sorted(c['name'] for c in inspector.get_columns(table)),
+                    sorted(i['name'] for i in inspector.get_indexes(table)))
+            for table in inspector.get_table_names()
+            if table != 'schema_migration'}
+
+
+def test_upgrade_downgrade():
+    """
+    Testing an old database is migrated to the models' schema and back
+    """
+    engine = baseline_engine()
+    before = schema(engine)
+    assert migrations.current_version(engine) == 0
+
+    assert len(migrations.upgrade(engine)) == len(migrations.MIGRATIONS)
+    assert migrations.current_version(engine) == migrations.HEAD
+    assert migrations.upgrade(engine) == []
+    after = schema(engine)
+    assert 'version' in after['user'][0]
+    assert 'ix_listing_owner_id' in after['listing'][1]
+    assert 'ix_booking_listing_dates' in after['booking'][1]
+    assert 'ledger_entry' in after
+    # rows survive and get the column defaults
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            'SELECT version FROM user').scalar() == 0
+
+    # The migrated tables match what the models would create
+    models = schema(db.engine)
+    for table, (columns, indexes) in after.items():
+        assert (columns, indexes) == models[table]
+
+    # Going down part of the way, then all the way
+    assert migrations.downgrade(engine, 3) == \
+        ['add user email change time', 'drop ledger booking foreign key',
+         'add listing counters', 'add booking date range index',
+         'add foreign key indexes']
+    assert migrations.current_version(engine) == 3
+    migrations.downgrade(engine, 0)
+    assert schema(engine) == before
+    engine.dispose()
+
+
+def test_upgrade_created_database():
+    """
+    Testing a database made by db.create_all() upgrades without changes
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'created.sqlite')
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    before = schema(engine)
+    assert migrations.upgrade(engine, 4) != []
+    assert migrations.current_version(engine) == 4
+    migrations.upgrade(engine)
+    assert schema(engine) == before
+    engine.dispose()
+
+
+def test_ledger_booking_foreign_key():
+    """
+    Testing the ledger loses its foreign key to the bookings, which may
+    live in the shards, and gets it back, keeping its rows
+    """
+    engine = baseline_engine()
+    migrations.upgrade(engine, 6)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO ledger_entry VALUES (1, 1, -10, 'booking', 7, "
+            "'2023-01-01 00:00:00')")
+
+    def booking_keys():
+        return [key['referred_table'] for key in
+                inspect(engine).get_foreign_keys('ledger_entry')
+                if key['constrained_columns'] == ['booking_id']]
+
+    assert booking_keys() == ['booking']
+    migrations.upgrade(engine)
+    assert booking_keys() == []
+    assert 'ix_ledger_entry_user_id' in schema(engine)['ledger_entry'][1]
+    migrations.downgrade(engine, 6)
+    assert booking_keys() == ['booking']
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            'SELECT booking_id FROM ledger_entry').scalar() == 7
+    engine.dispose()
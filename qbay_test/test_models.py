@@ -1,10 +1,24 @@
 from qbay.models import register, login, check_str_contains_lower, \
     check_str_contains_upper, check_str_contains_special, update_listing, \
-    User, Listing, create_listing, create_booking
-from datetime import date, timedelta
+    User, Listing, create_listing, create_booking, title_exists, \
+    update_listings, cached_user, user_cache, get_user, get_listing, \
+    get_user_by_email, identity_map_stats, register_many, known_emails, \
+    db, LedgerEntry, snapshot_balances, audit_balance, listings_near, \
+    load_fsa_adjacency, create_review, repair_listing_counters, \
+    FsaAdjacency
+from qbay import models
+from qbay.cache import LRUCache
+from qbay.ratelimit import RateLimiter
+from qbay.passwords import hash_password, verify_password, needs_rehash
+from qbay import app
+from qbay.bloom import BloomFilter
+from sqlalchemy.engine.default import CACHE_HIT
+from sqlalchemy import event, insert, inspect, update
+from datetime import date, datetime, timedelta
 
 import string
 import random
+import time
 
 valid_password = 'Abc#123'
 
@@ -1399,3 +1413,547 @@ def test_payload_create_booking_parameter_4():
 
     # No exceptions
     assert True
+
+
+def test_r4_8_title_exists():
+    """
+    Testing R4-8: title uniqueness probe used by create/update listing
+    """
+    user = register("bloomuser", "bloomuser@test.com", valid_password)
+    listing = create_listing("bloom title one",
+                             "This is a description of a bloom house",
+                             30.00, date(2022, 11, 26), user.id)
+    assert listing is not None
+
+    # Taken titles are found, fresh titles are not
+    assert title_exists("bloom title one")
+    assert title_exists("bloom title one", owner_id=user.id)
+    assert not title_exists("bloom title one", owner_id=user.id + 1000)
+    assert not title_exists("bloom title two")
+
+    # Still rejected on the second insert
+    assert create_listing("bloom title one",
+                          "This is a description of a bloom house",
+                          30.00, date(2022, 11, 26), user.id) is None
+
+
+def test_bloom_filter():
+    """
+    Testing the Bloom filter never gives false negatives
+    """
+    bloom = BloomFilter(1000, 0.01)
+    words = ['title%i' % i for i in range(1000)]
+    bloom.update(words)
+    assert len(bloom) == 1000
+    assert all(word in bloom for word in words)
+
+    # False positive rate stays close to the target
+    misses = sum('other%i' % i in bloom for i in range(1000))
+    assert misses < 50
+
+    bloom.clear()
+    assert 'title1' not in bloom
+
+
+class InWindowDate(date):
+    """
+    Date whose today() falls inside the R4-6/R5-3 modification window
+    """
+    @classmethod
+    def today(cls):
+        return date(2024, 6, 1)
+
+
+def test_r5_bulk_update_listings(monkeypatch):
+    """
+    Testing update_listings applies R4/R5 per listing in one transaction
+    """
+    owner = register("bulkowner", "bulkowner@test.com", valid_password)
+    other = register("bulkother", "bulkother@test.com", valid_password)
+    description = "This is a description of a bulk house"
+    listings = [create_listing("bulk house %i" % i, description, 100.00,
+                               date(2022, 11, 26), owner.id)
+                for i in range(3)]
+    foreign = create_listing("bulk house foreign", description, 100.00,
+                             date(2022, 11, 26), other.id)
+    ids = [listing.id for listing in listings]
+    monkeypatch.setattr(models, 'date', InWindowDate)
+
+    outcomes = update_listings([
+        {'id': ids[0], 'price': 150.00},
+        {'id': ids[1], 'price': 50.00},
+        {'id': ids[2], 'title': 'bulk house renamed', 'price': 120.00},
+        {'id': foreign.id, 'price': 200.00},
+        {'id': 999999, 'price': 200.00},
+    ], owner_id=owner.id)
+
+    assert outcomes == {ids[0]: True, ids[1]: False, ids[2]: True,
+                        foreign.id: False, 999999: False}
+
+    # Loaded objects see the new values
+    assert listings[0].price == 150.00
+    assert listings[1].price == 100.00
+    assert listings[2].title == 'bulk house renamed'
+    assert listings[2].price == 120.00
+    assert foreign.price == 100.00
+    assert title_exists('bulk house renamed')
+
+    # Two listings cannot take the same title in one batch
+    outcomes = update_listings([
+        {'id': ids[0], 'title': 'bulk house twin'},
+        {'id': ids[1], 'title': 'bulk house twin'},
+    ])
+    assert outcomes == {ids[0]: True, ids[1]: False}
+
+    # A repeated id fails and none of its changes are applied, which
+    # also frees the title it claimed
+    outcomes = update_listings([
+        {'id': ids[0], 'price': 160.00, 'title': 'bulk house repeated'},
+        {'id': ids[0], 'price': 170.00},
+        {'id': ids[2], 'title': 'bulk house repeated'},
+        'not a change',
+    ], owner_id=owner.id)
+    assert outcomes == {ids[0]: False, ids[2]: True, 'not a change': False}
+    assert listings[0].price == 150.00
+    assert listings[0].title == 'bulk house twin'
+    assert listings[2].title == 'bulk house repeated'
+
+
+def test_lru_cache():
+    """
+    Testing the LRU cache evicts the oldest entry and honours its TTL
+    """
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' was the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.pop('a') == 1
+    assert len(cache) == 1
+
+    expired = LRUCache(2, ttl=0)
+    expired.set('a', 1)
+    assert expired.get('a') is None
+
+
+def test_cached_user():
+    """
+    Testing the session user cache validates the session version and is
+    refreshed when the user changes
+    """
+    user = register("cacheuser", "cacheuser@test.com", valid_password)
+    version = user.version
+    user_cache.clear()
+
+    assert cached_user(user.id, version).email == "cacheuser@test.com"
+    assert user.id in user_cache
+    hits = user_cache.hits
+    assert cached_user(user.id, version).username == "cacheuser"
+    assert user_cache.hits == hits + 1
+    assert cached_user(user.id + 1000) is None
+
+    # Profile changes bump the version, the old session becomes stale
+    # and the cache already holds the new profile
+    assert user.update_user(username="cache user two",
+                            email="cacheuser2@test.com")
+    assert user.version > version
+    hits = user_cache.hits
+    assert cached_user(user.id, version) is None
+    fresh = cached_user(user.id, user.version)
+    assert fresh.username == "cache user two"
+    assert fresh.email == "cacheuser2@test.com"
+    assert user_cache.hits == hits + 2
+
+
+def test_identity_map():
+    """
+    Testing repeated lookups in one request reuse the loaded instance
+    """
+    user = register("memouser", "memouser@test.com", valid_password)
+    listing = create_listing("memo house",
+                             "This is a description of a memo house",
+                             30.00, date(2022, 11, 26), user.id)
+
+    first = get_listing(listing.id)
+    before = identity_map_stats()
+    assert get_listing(listing.id) is first
+    assert get_user_by_email("memouser@test.com") is get_user(user.id)
+    after = identity_map_stats()
+    assert after['hits'] >= before['hits'] + 2
+
+    # A commit expires the instance, reading it again is not a hit
+    listing_id = listing.id
+    db.session.commit()
+    before = identity_map_stats()
+    assert get_listing(listing_id) is first
+    after = identity_map_stats()
+    assert (after['hits'], after['misses']) == \
+        (before['hits'], before['misses'] + 1)
+
+    # A changed email is not served from the old key
+    assert user.update_email("memouser2@test.com")
+    assert get_user_by_email("memouser@test.com") is None
+    assert get_user_by_email("memouser2@test.com").id == user.id
+    assert get_listing(999999) is None
+
+    # The identity map of a long app context keeps a bounded number of
+    # instances
+    app.config['IDENTITY_MAP_SIZE'] = 2
+    try:
+        with app.app_context():
+            for _ in range(3):
+                register("memo user", "memo%s@test.com" % random.random(),
+                         valid_password)
+            for user_id in (1, 2, 3):
+                get_user(user_id)
+            assert len(models.identity_map()) == 2
+    finally:
+        del app.config['IDENTITY_MAP_SIZE']
+
+
+def test_r3_update_user_single_commit():
+    """
+    Testing update_user validates every field before writing any of them
+    """
+    user = register("atomicuser", "atomicuser@test.com", valid_password)
+    version = user.version
+
+    # An invalid postal code leaves the valid name untouched
+    assert user.update_user(username="atomic two",
+                            postal_code="bad code") is False
+    assert user.username == "atomicuser"
+    assert user.version == version
+
+    # Unchanged values do not cause a write
+    assert user.update_user(username="atomicuser") is True
+    assert user.version == version
+
+    # Several changed fields are saved with one version bump
+    assert user.update_user(username="atomic two", ship_addr="1 Main St",
+                            postal_code="K7L 3N6") is True
+    assert user.version == version + 1
+    assert login("atomicuser@test.com", valid_password).ship_addr \
+        == "1 Main St"
+
+    # A taken email is rejected without breaking the session
+    register("atomicother", "atomicother@test.com", valid_password)
+    assert user.update_email("atomicother@test.com") is False
+    assert user.email == "atomicuser@test.com"
+
+
+def test_password_hashing():
+    """
+    Testing passwords are stored hashed and rehashed when the work
+    factor changes
+    """
+    stored = hash_password(valid_password)
+    assert stored != valid_password
+    assert verify_password(valid_password, stored)
+    assert not verify_password('Abc#124', stored)
+    assert not needs_rehash(stored)
+
+    user = register("hashuser", "hashuser@test.com", valid_password)
+    assert user.password != valid_password
+    version = user.version
+
+    # A new work factor is applied on the next successful login
+    iterations = app.config['PASSWORD_ITERATIONS']
+    app.config['PASSWORD_ITERATIONS'] = iterations + 1
+    try:
+        assert needs_rehash(user.password)
+        assert login("hashuser@test.com", valid_password) is not None
+        assert not needs_rehash(user.password)
+    finally:
+        app.config['PASSWORD_ITERATIONS'] = iterations
+    assert user.version == version
+
+    # Plain passwords of old accounts still work and get upgraded
+    user.password = valid_password
+    assert login("hashuser@test.com", valid_password) is not None
+    assert user.password != valid_password
+    assert login("hashuser@test.com", 'Abc#124') is None
+
+
+def test_r1_register_many():
+    """
+    Testing bulk registration applies R1 and reports rejected rows
+    """
+    register("bulkexisting", "bulkexisting@test.com", valid_password)
+    records = [
+        {'name': 'bulk user %i' % i, 'email': 'bulk%i@test.com' % i,
+         'password': valid_password} for i in range(7)
+    ]
+    records += [
+        {'name': 'x', 'email': 'bulkbad@test.com', 'password': 'weak'},
+        {'name': 'bulk taken', 'email': 'bulkexisting@test.com',
+         'password': valid_password},
+        {'name': 'bulk twin', 'email': 'bulk0@test.com',
+         'password': valid_password},
+    ]
+
+    # Small chunks so rows are spread over several batches
+    created, rejected = register_many(iter(records), chunk_size=3)
+    assert created == 7
+    assert rejected == [(8, 'invalid name, password'),
+                        (9, 'email already registered'),
+                        (10, 'email already registered')]
+
+    user = login('bulk3@test.com', valid_password)
+    assert user.username == 'bulk user 3'
+    assert user.balance == 100
+    assert user.ship_addr == '' and user.postal_code == ''
+
+
+def test_login_rate_limiter():
+    """
+    Testing the login rate limiter allows a burst, then rejects, and
+    stays within its size
+    """
+    limiter = RateLimiter(attempts=3, window=60, maxsize=2)
+    assert all(limiter.allow('1.2.3.4') for i in range(3))
+    assert not limiter.allow('1.2.3.4')
+    assert limiter.allow('a@test.com')
+
+    # A third key evicts the least recently used one
+    assert limiter.allow('b@test.com')
+    assert limiter.stats() == {'allowed': 5, 'rejected': 1,
+                               'evicted': 1, 'tracked': 2}
+    assert limiter.allow('1.2.3.4')
+
+    # Attempts are earned back over the window
+    refill = RateLimiter(attempts=1, window=0.001)
+    assert refill.allow('key')
+    time.sleep(0.01)
+    assert refill.allow('key')
+
+
+def test_r2_known_emails():
+    """
+    Testing login rejects unknown emails from the filter and still finds
+    users registered or renamed elsewhere
+    """
+    user = register("filteruser", "filteruser@test.com", valid_password)
+    assert login("filteruser@test.com", valid_password) is not None
+    assert known_emails.might_exist("filteruser@test.com")
+    assert not known_emails.might_exist("nobody.here@test.com")
+
+    # Email changes are added to the filter
+    assert user.update_email("filteruser2@test.com")
+    assert login("filteruser2@test.com", valid_password) is not None
+
+    # A user inserted by another process is found by the catch up
+    db.session.add(User(username="elsewhere", email="elsewhere@test.com",
+                        password=hash_password(valid_password)))
+    db.session.commit()
+    known_emails.caught_up = 0
+    assert login("elsewhere@test.com", valid_password) is not None
+
+    # So is an email changed by another process
+    db.session.execute(update(User).where(User.id == user.id).values(
+        email="filteruser3@test.com", email_changed=datetime.utcnow()))
+    db.session.commit()
+    known_emails.caught_up = 0
+    assert login("filteruser3@test.com", valid_password) is not None
+
+    stats = known_emails.stats()
+    assert stats['emails'] > 0 and stats['memory_bytes'] > 0
+
+
+def test_booking_ledger():
+    """
+    Testing a booking debits the guest, pays the host and records both
+    in the ledger
+    """
+    host = register("ledgerhost", "ledgerhost@test.com", valid_password)
+    guest = register("ledgerguest", "ledgerguest@test.com", valid_password)
+    listing = create_listing("ledger house",
+                             "This is a description of a ledger house",
+                             60.00, date(2022, 11, 26), host.id)
+
+    booking = create_booking(guest.id, listing.id, date(2023, 1, 1),
+                             date(2023, 1, 3))
+    assert booking is not None
+    assert guest.balance == 40
+    assert host.balance == 160
+    entries = LedgerEntry.query.filter_by(booking_id=booking.id).all()
+    assert sorted(entry.amount for entry in entries) == [-60, 60]
+
+    # The remaining 40 cannot pay for a second stay
+    assert create_booking(guest.id, listing.id, date(2023, 2, 1),
+                          date(2023, 2, 3)) is None
+    assert guest.balance == 40
+
+    # Audits agree with the materialized balance, with or without a
+    # snapshot
+    assert audit_balance(guest.id) == (40, 40)
+    assert snapshot_balances() > 0
+    assert audit_balance(host.id) == (160, 160)
+    assert audit_balance(999999) is None
+
+
+def test_snapshot_during_transfer():
+    """
+    Testing a transfer committed while balances are snapshotted is not
+    counted twice by the audit
+    """
+    user = register("snapshotuser", "snapshotuser@test.com", valid_password)
+    injected = []
+
+    def transfer_elsewhere(conn, cursor, statement, *args):
+        # another worker commits a deposit right before the balances
+        # are read
+        if injected or 'balance' not in statement or \
+           not statement.lstrip().startswith('SELECT'):
+            return
+        injected.append(True)
+        with db.engine.begin() as connection:
+            connection.execute(update(User).where(User.id == user.id)
+                               .values(balance=User.balance + 5))
+            connection.execute(insert(LedgerEntry).values(
+                user_id=user.id, amount=5, kind='deposit',
+                created=datetime.utcnow()))
+
+    event.listen(db.engine, 'before_cursor_execute', transfer_elsewhere)
+    try:
+        assert snapshot_balances() > 0
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', transfer_elsewhere)
+    assert injected
+    assert audit_balance(user.id) == (105, 105)
+
+
+def test_listings_near(monkeypatch):
+    """
+    Testing nearby listings match the user's FSA and its neighbours, or
+    the FSAs of the same district without adjacency data
+    """
+    host = register("nearhost", "nearhost@test.com", valid_password)
+    guest = register("nearguest", "nearguest@test.com", valid_password)
+    description = "This is a description of a nearby house"
+    home = create_listing("near home", description, 50.00,
+                          date(2022, 11, 26), host.id, postal_code="K7L 3N6")
+    next_door = create_listing("near next door", description, 50.00,
+                               date(2022, 11, 26), host.id,
+                               postal_code="K7M 1A1")
+    far = create_listing("near far away", description, 50.00,
+                         date(2022, 11, 26), host.id,
+                         postal_code="M5V 2T6")
+    assert home.fsa == "K7L" and far.fsa == "M5V"
+    assert create_listing("near bad code", description, 50.00,
+                          date(2022, 11, 26), host.id,
+                          postal_code="k7l 3n6") is None
+
+    # Without a postal code there is nothing to match
+    assert listings_near(guest) == []
+
+    # Without adjacency rows the district K7 is used, own FSA first
+    assert guest.update_postal_code("K7L 1B2")
+    near = listings_near(guest)
+    assert near[0] == home and next_door in near and far not in near
+
+    # Adjacency rows are stored both ways and replace the fallback
+    assert load_fsa_adjacency([("M5V", "K7L")]) == 2
+    near = listings_near(guest)
+    assert home in near and far in near and next_door not in near
+    load_fsa_adjacency([])
+
+    # Rows loaded by another process are picked up once the cached
+    # table expires
+    monkeypatch.setattr(models, 'fsa_adjacency', LRUCache(1, ttl=0.2))
+    assert far not in listings_near(guest)
+    with db.engine.begin() as connection:
+        connection.execute(insert(FsaAdjacency), [
+            {'fsa': 'K7L', 'neighbour': 'M5V'},
+            {'fsa': 'M5V', 'neighbour': 'K7L'}])
+    assert far not in listings_near(guest)
+    time.sleep(0.3)
+    assert far in listings_near(guest)
+    load_fsa_adjacency([])
+
+
+def test_cached_statements():
+    """
+    Testing the hot lookups run their prebuilt statements from the
+    compiled statement cache
+    """
+    user = register("stmtuser", "stmtuser@test.com", valid_password)
+    assert models.lookup(User, 'email', "stmtuser@test.com") is user
+    assert models.lookup(User, 'email', "nobody@test.com") is None
+
+    # An instance in the session is found by id without a query
+    assert models.lookup(User, 'id', user.id) is user
+    db.session.expunge(user)
+    assert models.lookup(User, 'id', user.id).email == "stmtuser@test.com"
+
+    # An expired instance is refreshed by the lookup statement
+    user = models.lookup(User, 'email', "stmtuser@test.com")
+    user_id = user.id
+    db.session.commit()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        assert models.lookup(User, 'id', user_id) is user
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert len(statements) == 1
+    assert not inspect(user).expired_attributes
+
+    # An instance marked for deletion is not returned
+    db.session.delete(user)
+    assert models.lookup(User, 'id', user_id) is None
+    db.session.rollback()
+
+    # The second execution reuses the compiled SQL
+    for _ in range(2):
+        result = db.session.connection().execute(
+            models.USER_BY_EMAIL, {'value': "stmtuser@test.com"})
+    assert result.context.cache_hit == CACHE_HIT
+
+
+def test_listing_counters():
+    """
+    Testing bookings and reviews keep the listing counters up to date,
+    and the repair recomputes them
+    """
+    host = register("counthost", "counthost@test.com", valid_password)
+    guest = register("countguest", "countguest@test.com", valid_password)
+    listing = create_listing("counted house",
+                             "This is a description of a counted house",
+                             20.00, date(2022, 11, 26), host.id)
+    assert (listing.booking_count, listing.review_count,
+            listing.next_available_date) == (0, 0, None)
+    assert listing.booked_until is None
+
+    assert create_booking(guest.id, listing.id, date(2023, 5, 10),
+                          date(2023, 5, 12)) is not None
+    assert create_booking(guest.id, listing.id, date(2023, 4, 1),
+                          date(2023, 4, 2)) is not None
+    assert listing.booking_count == 2
+    assert listing.next_available_date == date(2023, 5, 13)
+    assert listing.booked_until == date(2023, 5, 12)
+
+    # A refused booking does not count
+    assert create_booking(guest.id, listing.id, date(2023, 5, 11),
+                          date(2023, 5, 20)) is None
+    assert listing.booking_count == 2
+
+    assert create_review(guest.id, listing.id, "Lovely stay") is not None
+    assert create_review(host.id, listing.id, "My own house") is None
+    assert create_review(guest.id, listing.id, "") is None
+    assert listing.review_count == 1
+
+    # Counters that drifted are recomputed
+    assert repair_listing_counters() == 0
+    listing.booking_count = 7
+    listing.next_available_date = None
+    db.session.commit()
+    assert repair_listing_counters() == 1
+    assert (listing.booking_count, listing.review_count,
+            listing.next_available_date) == (2, 1, date(2023, 5, 13))
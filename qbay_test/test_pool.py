@@ -0,0 +1,91 @@
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, exc
+
+from qbay import app
+from qbay.pool import InstrumentedQueuePool, engine_options, pool_stats, \
+    sqlite_pragmas, tune_sqlite
+
+'''
+This file tests the database connection pool settings and metrics
+'''
+
+
+def test_engine_options():
+    """
+    Testing the pool settings only size pools that can be pooled
+    """
+    config = dict(app.config)
+    config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root@db/qa327'
+    options = engine_options(config)
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert options['pool_size'] == config['DB_POOL_SIZE']
+    assert options['pool_recycle'] == config['DB_POOL_RECYCLE']
+
+    for uri in ('sqlite://', 'sqlite:///:memory:'):
+        config['SQLALCHEMY_DATABASE_URI'] = uri
+        assert 'pool_size' not in engine_options(config)
+
+
+def test_pool_stats():
+    """
+    Testing the pool reports connections in use, overflow and timeouts
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'pool.sqlite')
+    engine = create_engine('sqlite:///' + path,
+                           poolclass=InstrumentedQueuePool, pool_size=1,
+                           max_overflow=1, pool_timeout=0.05)
+    first = engine.connect()
+    second = engine.connect()
+    stats = pool_stats(engine.pool)
+    assert stats['in_use'] == 2
+    assert stats['overflow'] == 1
+    assert stats['checkouts'] == 2
+
+    # Both connections are taken, so the next checkout times out
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    assert pool_stats(engine.pool)['timeouts'] == 1
+
+    first.close()
+    second.close()
+    stats = pool_stats(engine.pool)
+    assert stats['in_use'] == 0
+    assert stats['wait_max_ms'] > 0
+    engine.dispose()
+
+
+def test_tune_sqlite():
+    """
+    Testing the tuned profile is applied to every new SQLite connection
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'tuned.sqlite')
+    engine = create_engine('sqlite:///' + path,
+                           poolclass=InstrumentedQueuePool)
+    assert tune_sqlite(engine, sqlite_pragmas(app.config))
+    with engine.connect() as first, engine.connect() as second:
+        for connection in (first, second):
+            pragma = connection.exec_driver_sql
+            assert pragma('PRAGMA journal_mode').scalar() == 'wal'
+            # NORMAL
+            assert pragma('PRAGMA synchronous').scalar() == 1
+            assert pragma('PRAGMA busy_timeout').scalar() == \
+                app.config['SQLITE_BUSY_TIMEOUT']
+            assert pragma('PRAGMA cache_size').scalar() == \
+                -app.config['SQLITE_CACHE_KB']
+    engine.dispose()
+
+    # In-memory databases and other databases are left alone
+    assert not tune_sqlite(create_engine('sqlite://'), [])
+
+
+def test_metrics_db_pool():
+    """
+    Testing /metrics exposes the pool of the app's database
+    """
+    from qbay import controllers  # noqa: F401 registers the routes
+    metrics = app.test_client().get('/metrics').get_json()
+    assert metrics['db_pool']['pool'] == 'InstrumentedQueuePool'
+    assert metrics['db_pool']['checkouts'] > 0
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import tempfile
+
+from flask import Flask, request
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+from qbay.passwords import hash_password
+from qbay.queries import count_queries, redact
+
+'''
+This file tests the per-request SQL statement counter
+'''
+
+
+def query_app(**config):
+    """
+    Creates a small app with one route loading items one by one
+    """
+    app = Flask(__name__)
+    app.config['SLOW_QUERY_LOG'] = ''
+    app.config.update(config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'queries.sqlite')
+    app.config['QUERY_BUDGET'] = 5
+    app.config['QUERY_REPEAT_LIMIT'] = 3
+    app.debug = True
+    db = SQLAlchemy(app)
+
+    class Item(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        label = db.Column(db.String(200))
+
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Item(id=i) for i in range(1, 11)])
+        db.session.commit()
+        count_queries(app, db.engines.values())
+
+    @app.route('/items/<int:count>')
+    def items(count):
+        # one query per item, the N+1 pattern
+        for i in range(1, count + 1):
+            db.session.get(Item, i)
+        return 'ok'
+
+    @app.route('/items/bulk', methods=['POST'])
+    def bulk():
+        # one executemany, like register_many
+        db.session.execute(insert(Item), [
+            {'id': 100 + i, 'label': label}
+            for i, label in enumerate(request.form.getlist('label'))])
+        db.session.commit()
+        return 'ok'
+
+    @app.route('/items/duplicate')
+    def duplicate():
+        # a statement that raises, then one that works
+        db.session.add(Item(id=1))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        db.session.get(Item, 2)
+        return 'ok'
+
+    return app
+
+
+def test_query_counter(caplog):
+    """
+    Testing each response reports its own statements in debug mode
+    """
+    client = query_app().test_client()
+    with caplog.at_level(logging.WARNING):
+        response = client.get('/items/2')
+    assert response.headers['X-Query-Count'] == '2'
+    assert float(response.headers['X-Query-Time-Ms']) > 0
+    assert caplog.records == []
+
+    # The next request starts from zero
+    assert client.get('/items/1').headers['X-Query-Count'] == '1'
+
+
+def test_failed_statement_timing():
+    """
+    Testing a statement that raises leaves no timing behind on its
+    pooled connection
+    """
+    app = query_app()
+    client = app.test_client()
+    for _ in range(3):
+        # only the statement that completed is counted
+        response = client.get('/items/duplicate')
+        assert response.headers['X-Query-Count'] == '1'
+    with app.app_context():
+        engine = app.extensions['sqlalchemy'].engine
+        with engine.connect() as connection:
+            assert connection.info.get('query_start', []) == []
+
+
+def test_query_warnings(caplog):
+    """
+    Testing requests over budget or repeating a statement are logged
+    """
+    client = query_app().test_client()
+    with caplog.at_level(logging.WARNING):
+        assert client.get('/items/3').headers['X-Query-Count'] == '3'
+    messages = [record.getMessage() for record in caplog.records]
+    assert len(messages) == 1
+    assert 'GET /items/3 ran the same statement 3 times' in messages[0]
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        client.get('/items/6')
+    messages = [record.getMessage() for record in caplog.records]
+    assert any('ran 6 SQL statements, over its budget of 5' in message
+               for message in messages)
+
+
+def test_slow_query_log():
+    """
+    Testing slow statements are logged with route, caller and plan
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'slow.log')
+    client = query_app(SLOW_QUERY_LOG=path, SLOW_QUERY_MS=0).test_client()
+    client.get('/items/1')
+    with open(path) as f:
+        entry = json.loads(f.readline())
+    assert entry['statement'].startswith('SELECT')
+    assert entry['parameters'] == [1]
+    assert entry['route'] == 'GET /items/1'
+    assert entry['function'].endswith('.items')
+    # SQLite's EXPLAIN QUERY PLAN, the lookup uses the primary key
+    assert any('PRIMARY KEY' in str(row) for row in entry['plan'])
+
+    # Faster statements are left out
+    client = query_app(SLOW_QUERY_LOG=path,
+                       SLOW_QUERY_MS=60000).test_client()
+    client.get('/items/1')
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+
+    # Password hashes never reach the log, also from an executemany
+    stored = hash_password('Abc#123', iterations=1000)
+    assert redact(['user', stored]) == ['user', '<password hash>']
+    assert redact({'password': stored}) == {'password': '<password hash>'}
+    path = os.path.join(tempfile.mkdtemp(), 'slow.log')
+    client = query_app(SLOW_QUERY_LOG=path, SLOW_QUERY_MS=0).test_client()
+    client.post('/items/bulk', data={'label': [stored, stored]})
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    bulk = [entry for entry in entries
+            if entry['statement'].startswith('INSERT')]
+    assert bulk and bulk[0]['parameters'] == [[100, '<password hash>'],
+                                              [101, '<password hash>']]
+    assert all('pbkdf2' not in json.dumps(entry) for entry in entries)
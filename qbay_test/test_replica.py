@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+from qbay.replica import RoutingSession, STICKY_COOKIE, route_reads
+
+'''
+This file tests read replica routing, with two SQLite files standing in
+for the primary and the replica
+'''
+
+
+def replica_app():
+    """
+    Creates a small app with a primary and a replica database that do
+    not replicate, so every answer shows which one was read
+    """
+    directory = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(directory, 'primary.sqlite')
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica': 'sqlite:///' + os.path.join(directory, 'replica.sqlite')}
+    app.config['REPLICA_STICKY_SECONDS'] = 5
+    db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+    route_reads(app)
+
+    class Item(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    with app.app_context():
+        db.create_all()
+        db.metadata.create_all(db.engines['replica'])
+        # rows only the replica has
+        with db.engines['replica'].begin() as connection:
+            connection.execute(Item.__table__.insert(),
+                               [{'id': 1}, {'id': 2}, {'id': 3}])
+
+    @app.route('/items', methods=['GET'])
+    def items():
+        return str(Item.query.count())
+
+    @app.route('/items', methods=['POST'])
+    def add_item():
+        db.session.add(Item())
+        db.session.commit()
+        return str(Item.query.count())
+
+    @app.route('/items/touch', methods=['GET'])
+    def touch():
+        # a GET that writes reads its own write from the primary
+        db.session.add(Item())
+        db.session.flush()
+        count = Item.query.count()
+        db.session.commit()
+        return str(count)
+
+    return app, db, Item
+
+
+def test_replica_routing():
+    """
+    Testing reads of GET requests go to the replica and writes to the
+    primary
+    """
+    app, db, Item = replica_app()
+    client = app.test_client()
+    assert client.get('/items').text == '3'
+    assert client.post('/items').text == '1'
+
+    # Code outside of requests only uses the primary
+    with app.app_context():
+        assert Item.query.count() == 1
+
+    # A GET that writes switches to the primary
+    assert app.test_client().get('/items/touch').text == '2'
+
+
+def test_replica_read_your_writes():
+    """
+    Testing a client reads from the primary right after a POST, while
+    other clients keep reading from the replica
+    """
+    app, db, Item = replica_app()
+    client = app.test_client()
+    response = client.post('/items')
+    assert STICKY_COOKIE in response.headers['Set-Cookie']
+    assert client.get('/items').text == '1'
+    assert app.test_client().get('/items').text == '3'
+
+    # Once the cookie is gone the client reads from the replica again
+    client.delete_cookie(STICKY_COOKIE)
+    assert client.get('/items').text == '3'
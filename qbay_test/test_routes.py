@@ -0,0 +1,99 @@
+from datetime import date
+
+from sqlalchemy import event
+
+from qbay import app, load_app
+from qbay.controllers import ip_limiter
+from qbay.models import create_listing, db, register
+
+'''
+This file tests routes through the app's test client
+'''
+
+valid_password = 'Abc#123'
+
+
+def logged_in_client(name, email):
+    """
+    Registers a user and returns a test client logged in as that user
+    """
+    user = register(name, email, valid_password)
+    client = load_app().test_client()
+    client.post('/login', data={'email': email, 'password': valid_password})
+    return user, client
+
+
+def test_bulk_update_malformed_ids():
+    """
+    Testing the bulk update answers ids that are not integers with a
+    failed outcome instead of an error
+    """
+    user, client = logged_in_client('routeowner', 'routeowner@test.com')
+    listing = create_listing('route house', 'This is a description of a '
+                             'route house', 100.00, date(2022, 11, 26),
+                             user.id)
+
+    response = client.post('/listing/bulk_update', json={'changes': [
+        {'id': [1], 'price': 150},
+        {'id': {}, 'price': 150},
+        {'id': True, 'price': 150},
+        {'price': 150},
+        {'id': listing.id, 'price': 10},
+    ]})
+    assert response.status_code == 200
+    assert response.get_json() == {'[1]': False, '{}': False,
+                                   'True': False, 'None': False,
+                                   str(listing.id): False}
+
+
+def test_login_rate_limit():
+    """
+    Testing a client posting more than LOGIN_ATTEMPTS_PER_IP logins is
+    answered with 429 before any login query runs
+    """
+    register('routelimit', 'routelimit@test.com', valid_password)
+    client = load_app().test_client()
+    address = '10.0.0.36'
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    app.config['LOGIN_RATE_LIMIT'] = True
+    try:
+        for attempt in range(ip_limiter.attempts):
+            response = client.post(
+                '/login', data={'email': 'routelimit%i@test.com' % attempt,
+                                'password': 'Wrong#123'},
+                environ_base={'REMOTE_ADDR': address})
+            assert response.status_code == 200
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = client.post(
+                '/login', data={'email': 'routelimit@test.com',
+                                'password': valid_password},
+                environ_base={'REMOTE_ADDR': address})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+    finally:
+        app.config['LOGIN_RATE_LIMIT'] = False
+        ip_limiter.reset(address)
+    assert response.status_code == 429
+    assert b'too many login attempts' in response.data
+    assert statements == []
+
+
+def test_booking_page_booked_until():
+    """
+    Testing the booking page shows the last booked day of a listing
+    rather than claiming it is free from the day after
+    """
+    user, client = logged_in_client('routebooked', 'routebooked@test.com')
+    create_listing('booked route house', 'This is a description of a '
+                   'booked route house', 100.00, date(2022, 11, 26),
+                   user.id)
+
+    page = client.get('/booking').text
+    assert 'Booked Until' in page and 'Available From' not in page
+    assert 'Not booked' in page
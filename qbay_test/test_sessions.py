@@ -0,0 +1,112 @@
+import os
+import tempfile
+
+from flask import Flask, session
+
+from qbay.sessions import ServerSideSessionInterface, SQLiteSessionStore
+
+'''
+This file tests the server-side session store
+'''
+
+
+def session_app():
+    """
+    Creates a small app using a fresh session store
+    """
+    app = Flask(__name__)
+    path = os.path.join(tempfile.mkdtemp(), 'sessions.sqlite')
+    app.session_interface = ServerSideSessionInterface(
+        SQLiteSessionStore(path))
+
+    @app.route('/login/<int:user_id>')
+    def login(user_id):
+        session['logged_in'] = [user_id, 0]
+        return 'ok'
+
+    @app.route('/visit')
+    def visit():
+        session['visits'] = session.get('visits', 0) + 1
+        return 'ok'
+
+    @app.route('/whoami')
+    def whoami():
+        return str(session.get('logged_in', ['nobody'])[0])
+
+    @app.route('/logout')
+    def logout():
+        session.pop('logged_in', None)
+        return 'ok'
+
+    return app
+
+
+def test_server_side_session():
+    """
+    Testing the browser only holds an opaque id and the data is served
+    from the store
+    """
+    app = session_app()
+    client = app.test_client()
+    assert client.get('/whoami').text == 'nobody'
+
+    client.get('/login/7')
+    cookie = client.get_cookie('session')
+    assert cookie is not None
+    assert app.session_interface.store.load(cookie.value) is not None
+    assert client.get('/whoami').text == '7'
+
+    # The data survives a cold cache
+    app.session_interface.cache.clear()
+    assert client.get('/whoami').text == '7'
+
+    # Logging out removes the stored session
+    client.get('/logout')
+    assert client.get('/whoami').text == 'nobody'
+    assert app.session_interface.store.load(cookie.value) is None
+
+
+def test_login_rotates_session_id():
+    """
+    Testing a login replaces the session id the browser had before, so
+    an id planted by someone else does not get logged in
+    """
+    app = session_app()
+    client = app.test_client()
+    client.get('/visit')
+    planted = client.get_cookie('session').value
+
+    client.get('/login/7')
+    sid = client.get_cookie('session').value
+    assert sid != planted
+    assert app.session_interface.store.load(planted) is None
+    assert client.get('/whoami').text == '7'
+
+    attacker = app.test_client()
+    attacker.set_cookie('session', planted)
+    assert attacker.get('/whoami').text == 'nobody'
+
+    # Logging in as another user rotates again, a request that keeps
+    # the login does not
+    client.get('/visit')
+    assert client.get_cookie('session').value == sid
+    client.get('/login/8')
+    assert client.get_cookie('session').value != sid
+
+
+def test_revoke_user_sessions():
+    """
+    Testing every session of a user can be ended centrally
+    """
+    app = session_app()
+    first = app.test_client()
+    second = app.test_client()
+    other = app.test_client()
+    first.get('/login/1')
+    second.get('/login/1')
+    other.get('/login/2')
+
+    assert app.session_interface.revoke_user(1) == 2
+    assert first.get('/whoami').text == 'nobody'
+    assert second.get('/whoami').text == 'nobody'
+    assert other.get('/whoami').text == '2'
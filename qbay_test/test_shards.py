@@ -0,0 +1,210 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import date
+
+from sqlalchemy import create_engine
+
+from qbay import shards
+
+'''
+This file tests the booking shards, on their own and through the models
+of an app started with booking_shards=3
+'''
+
+
+def test_insert_booking():
+    """
+    Testing each shard hands out its own ids and refuses overlapping
+    stays of a listing
+    """
+    directory = tempfile.mkdtemp()
+    engines = [create_engine('sqlite:///' +
+                             os.path.join(directory, '%i.sqlite' % shard))
+               for shard in range(3)]
+    # the main database used booking ids up to 10
+    shards.create_shards(engines, 10)
+
+    def book(listing_id, start, end):
+        shard = shards.shard_index(listing_id, 3)
+        with engines[shard].connect() as connection:
+            booking_id = shards.insert_booking(connection, shard, 3, {
+                'user_id': 1, 'listing_id': listing_id,
+                'booking_date': date(2023, 1, 1), 'start_date': start,
+                'end_date': end})
+            connection.commit()
+        return booking_id
+
+    assert book(3, date(2023, 2, 1), date(2023, 2, 3)) == 11
+    assert book(1, date(2023, 2, 1), date(2023, 2, 3)) == 12
+    assert book(4, date(2023, 2, 1), date(2023, 2, 3)) == 15
+    assert book(4, date(2023, 2, 2), date(2023, 2, 8)) is None
+    assert book(4, date(2023, 2, 4), date(2023, 2, 8)) == 18
+
+    found = shards.fan_out(engines, shards.USER_BOOKINGS, {'user_id': 1})
+    assert [[row.id for row in rows] for rows in found] == \
+        [[11], [12, 15, 18], []]
+    # creating the shards again keeps their id base
+    shards.create_shards(engines, 99)
+    assert shards.id_base(engines[0]) == 10
+
+
+# Run in fresh interpreters, since the shards are configured when qbay
+# is imported. The first books a listing before the switch to shards.
+UNSHARDED = '''
+from datetime import date
+from qbay import app
+from qbay import models
+
+app.config['PASSWORD_ITERATIONS'] = 1000
+with app.app_context():
+    models.init_schema()
+    host = models.register('shardhost', 'shardhost@test.com', 'Abc#123')
+    guest = models.register('shardguest', 'shardguest@test.com', 'Abc#123')
+    listing = models.create_listing(
+        'unsharded house', 'This is a description of an unsharded house',
+        10.00, date(2022, 11, 26), host.id)
+    print(models.create_booking(guest.id, listing.id, date(2023, 5, 10),
+                                date(2023, 5, 12)).id)
+'''
+SHARDED = '''
+from datetime import date
+from qbay import app, load_app
+from qbay import models
+
+app.config['PASSWORD_ITERATIONS'] = 1000
+with app.app_context():
+    try:
+        models.init_schema()
+    except RuntimeError:
+        print('refused')
+    print(models.move_bookings_to_shards())
+    models.init_schema()
+    host = models.get_user_by_email('shardhost@test.com')
+    guest = models.get_user_by_email('shardguest@test.com')
+    # the moved booking still blocks its dates
+    print(models.create_booking(guest.id, 1, date(2023, 5, 11),
+                                date(2023, 5, 20)))
+    listings = [models.create_listing(
+        'sharded house %i' % number,
+        'This is a description of a sharded house', 10.00,
+        date(2022, 11, 26), host.id) for number in range(4)]
+    booked = [models.create_booking(guest.id, listing.id, date(2023, 5, 10),
+                                    date(2023, 5, 12))
+              for listing in listings]
+    print(sorted(booking.id for booking in booked))
+    print([booking.id for booking in models.user_bookings(guest.id)])
+    print(models.repair_listing_counters(),
+          models.get_listing(1).booking_count)
+
+client = load_app().test_client()
+client.post('/login', data={'email': 'shardguest@test.com',
+                            'password': 'Abc#123'})
+page = client.get('/').text
+print(all('booking_%i' % booking.id in page for booking in booked))
+'''
+# Makes the commits of shard 1 fail after the payment went through
+FAILING_SHARD = '''
+from datetime import date
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+from qbay import app
+from qbay import models
+
+commit = Connection.commit
+
+
+def failing_commit(connection):
+    if str(connection.engine.url).endswith('bookings_1.sqlite'):
+        raise OperationalError('COMMIT', {}, Exception('database is locked'))
+    commit(connection)
+
+
+Connection.commit = failing_commit
+app.config['PASSWORD_ITERATIONS'] = 1000
+with app.app_context():
+    models.init_schema()
+    host = models.register('shardhost', 'shardhost@test.com', 'Abc#123')
+    guest = models.register('shardguest', 'shardguest@test.com', 'Abc#123')
+    listing = models.create_listing(
+        'unlucky house', 'This is a description of an unlucky house',
+        10.00, date(2022, 11, 26), host.id)
+    print(models.create_booking(guest.id, listing.id, date(2023, 5, 10),
+                                date(2023, 5, 12)))
+    print(models.get_user(guest.id).balance, models.get_user(host.id).balance,
+          models.get_listing(listing.id).booking_count,
+          models.user_bookings(guest.id))
+    print(sorted(entry.kind for entry in models.LedgerEntry.query))
+'''
+
+
+def run_child(code, directory, shard_count):
+    """
+    Runs code in a fresh interpreter against the databases of directory
+    """
+    return subprocess.run(
+        [sys.executable, '-c', code], capture_output=True, text=True,
+        env=dict(os.environ, booking_shards=str(shard_count),
+                 db_string='sqlite:///' + os.path.join(directory,
+                                                       'db.sqlite'),
+                 booking_shard_string='sqlite:///' + os.path.join(
+                     directory, 'bookings_{}.sqlite'),
+                 session_db=os.path.join(directory, 'sessions.sqlite'),
+                 slow_query_log=''))
+
+
+def test_sharded_bookings():
+    """
+    Testing bookings made before the switch are moved into the shards,
+    new bookings go to the shard of their listing with ids above the old
+    ones, and the bookings of a user are gathered from every shard
+    """
+    directory = tempfile.mkdtemp()
+    result = run_child(UNSHARDED, directory, 0)
+    assert result.stdout.strip() == '1', result.stderr
+
+    result = run_child(SHARDED, directory, 3)
+    assert result.returncode == 0, result.stderr
+    refused, moved, overlap, ids, listed, repaired, page = \
+        result.stdout.splitlines()
+    assert (refused, moved, overlap) == ('refused', '1', 'None')
+    assert ids == '[2, 3, 4, 7]'
+    assert listed == '[1, 2, 3, 4, 7]'
+    assert repaired == '0 1'
+    assert page == 'True'
+
+    # each booking is in the shard chosen by its listing id, and the
+    # main database keeps none
+    for shard in range(3):
+        path = os.path.join(directory, 'bookings_%i.sqlite' % shard)
+        with sqlite3.connect(path) as connection:
+            for (listing_id,) in connection.execute(
+                    'SELECT listing_id FROM booking'):
+                assert listing_id % 3 == shard
+    with sqlite3.connect(os.path.join(directory, 'db.sqlite')) as connection:
+        assert connection.execute(
+            'SELECT count(*) FROM booking').fetchone() == (0,)
+
+
+def test_failed_shard_commit():
+    """
+    Testing a booking is refunded when its shard fails to save it
+    """
+    result = run_child(FAILING_SHARD, tempfile.mkdtemp(), 3)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines() == [
+        'None', '100.0 100.0 0 []',
+        "['booking', 'payout', 'payout reversal', 'refund']"]
+
+
+def test_fan_out_pool():
+    """
+    Testing a pool handed out keeps working when another number of
+    shards is queried
+    """
+    pool = shards.fan_out_pool(2)
+    assert shards.fan_out_pool(5) is not pool
+    assert shards.fan_out_pool(2) is pool
+    assert list(pool.map(abs, [-1, -2])) == [1, 2]
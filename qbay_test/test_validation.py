@@ -0,0 +1,125 @@
+import random
+import re
+import string
+
+from qbay.validation import valid_email_syntax, valid_password, \
+    valid_name, valid_title, valid_description, valid_price, validate_many
+
+'''
+This file tests the shared input validators
+'''
+
+# The R1-3 pattern that valid_email_syntax replaces
+original_email_pattern = re.compile(
+    r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(.[A-Z|a-z]{2,})+')
+
+
+def random_piece(alphabet, max_length):
+    """
+    Generates a random string of up to max_length characters
+    """
+    return ''.join(random.choice(alphabet)
+                   for i in range(random.randint(0, max_length)))
+
+
+def random_email():
+    """
+    Generates a string close to an email address, often a valid one
+    """
+    email = random_piece('aZ09.@_', 4)
+    email += random.choice(['@', '', '@@'])
+    email += random_piece('a0-.', 4)
+    for i in range(random.randint(0, 3)):
+        email += random.choice('.|@\n-a') + random_piece('aZ|0', 3)
+    # sometimes insert an unexpected character
+    if random.random() < 0.3:
+        position = random.randint(0, len(email))
+        email = email[:position] + random.choice('!\n /:\\[') + \
+            email[position:]
+    return email
+
+
+def test_r1_3_email_differential():
+    '''
+    Testing R1-3: the linear validator accepts and rejects exactly what
+    the original regular expression does
+    '''
+    samples = ['an.eMa_il@gmail.uk.ca.com', 'a@b.co', 'a@b.c',
+               'a@b.co\n', 'a.b@c-d.e|f', 'a@@b.co', 'a@b@c.co',
+               '0@0-.AA', 'a/b@c.de', 'a..b@c.de', '.a@b.co', 'a@.co',
+               'a@b..co', 'a@b.co.', 'a@bxcom', 'im proper@gmail.com']
+    random.seed(327)
+    samples += [random_email() for i in range(20000)]
+
+    accepted = 0
+    for email in samples:
+        expected = re.fullmatch(original_email_pattern, email) is not None
+        assert valid_email_syntax(email) == expected, repr(email)
+        accepted += expected
+    # make sure both outcomes were exercised
+    assert 0 < accepted < len(samples)
+
+
+def test_r1_3_email_pathological():
+    '''
+    Testing R1-3: inputs that made the regular expression backtrack are
+    rejected quickly
+    '''
+    assert not valid_email_syntax('0' * 100000)
+    assert not valid_email_syntax('A0' * 50000 + '!')
+    assert not valid_email_syntax('a@' + '-' * 100000)
+    assert valid_email_syntax('a' * 50000 + '@b.co')
+
+
+def test_r1_4_password_single_pass():
+    '''
+    Testing R1-4: the single pass classifier agrees with checking every
+    character class separately
+    '''
+    random.seed(14)
+    alphabet = string.ascii_letters + string.digits + string.punctuation
+    for i in range(2000):
+        password = random_piece(alphabet, 10)
+        expected = len(password) >= 6 \
+            and any(x == x.upper() for x in password) \
+            and any(x == x.lower() for x in password) \
+            and any(x in string.punctuation for x in password)
+        assert valid_password(password) == expected, password
+    assert not valid_password(None)
+
+
+def test_r4_1_title_rules():
+    '''
+    Testing R4-1/R4-2: create_listing and update_listing share one rule
+    '''
+    assert valid_title('nice house 2')
+    assert valid_title('a' * 80)
+    assert not valid_title('a' * 81)
+    assert not valid_title('')
+    assert not valid_title(' house')
+    assert not valid_title('house ')
+    assert not valid_title('house!')
+    assert not valid_title('house\n')
+    assert not valid_title(None)
+    assert valid_description('x' * 20, 'title')
+    assert not valid_description('x' * 20, 'x' * 20)
+    assert not valid_description('x' * 19)
+    assert valid_price(10) and valid_price(10000.0)
+    assert not valid_price(9.99) and not valid_price('20')
+
+
+def test_validate_many():
+    '''
+    Testing validate_many reports the invalid fields of each record
+    '''
+    records = [
+        {'name': 'good name', 'email': 'good@test.com',
+         'password': 'Abc#123'},
+        {'name': ' bad', 'email': 'bad', 'password': 'Abc#123'},
+        {'title': 'house', 'price': 5, 'other': 'ignored'},
+    ]
+    assert validate_many(records) == [[], ['name', 'email'], ['price']]
+    # a missing field counts as invalid
+    assert validate_many(records, fields=['name']) == \
+        [[], ['name'], ['name']]
+    assert valid_name('abc') and not valid_name('ab')